@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+"""Benchmarks for the hot paths of the MasterTickets plugin.
+
+Builds a temporary Trac environment on SQLite, fills it with synthetic
+tickets linked in one of several topologies, and times the plugin's main
+entry points. For each benchmark the wall time (best and median of
+`--repeat` runs), the number of SQL queries per call and the growth of the
+process' peak memory are recorded.
+
+Examples::
+
+    python benchmarks/bench.py --topology chain --tickets 2000 --output chain.json
+    python benchmarks/bench.py --topology chain --tickets 2000 --baseline chain.json
+
+    # Reachability through mastertickets_closure against WITH RECURSIVE,
+    # and the cost of keeping the closure up to date, on a random DAG with
+    # 100k links
+    python benchmarks/bench.py --topology dag --tickets 20000 --degree 5 --closure
+
+With `--baseline`, every benchmark whose median is more than `--tolerance`
+slower, or which runs more queries than in the baseline, is reported and
+the script exits with status 1.
+
+The DepGraph macro is timed with its in-memory memo cleared before each
+run, but the on-disk render cache stays warm after the first run, so it
+measures building the graph rather than running dot.
+"""
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import trac
+from trac.db.util import IterableCursor
+from trac.env import Environment
+from trac.test import Mock, MockPerm
+from trac.ticket.model import Ticket
+from trac.util.datefmt import utc, to_utimestamp
+from trac.web.href import Href
+
+from mastertickets.api import MasterTicketsSystem
+from mastertickets.web_ui import MasterTicketsModule
+from mastertickets.macro_provider import MasterTicketsMacros
+from mastertickets.model import TicketLinks, find_cycle, rebuild_link_fields, \
+                                rebuild_blocker_counts, rebuild_closure
+
+
+# Topologies: each returns the links between tickets 1..n and the ticket
+# the benchmarks start from
+def chain(n, rand, degree):
+    """A single long chain, 1 blocks 2 blocks 3 ..."""
+    return [(i, i + 1) for i in xrange(1, n)], n // 2
+
+def hub(n, rand, degree):
+    """Ticket 1 blocks every other ticket."""
+    return [(1, i) for i in xrange(2, n + 1)], 1
+
+def dag(n, rand, degree):
+    """About `degree` random links per ticket, always to a higher id."""
+    links = set()
+    while len(links) < min(n * degree, n * (n - 1) // 2):
+        source, dest = rand.randint(1, n), rand.randint(1, n)
+        if source < dest:
+            links.add((source, dest))
+    return sorted(links), n // 2
+
+def diamonds(n, rand, degree):
+    """A chain of diamonds, 1 blocks 2 and 3 which both block 4 ..."""
+    links = []
+    for top in xrange(1, n - 2, 3):
+        links += [(top, top + 1), (top, top + 2), (top + 1, top + 3), (top + 2, top + 3)]
+    return links, (n // 6) * 3 + 1
+
+TOPOLOGIES = {'chain': chain, 'hub': hub, 'dag': dag, 'diamonds': diamonds}
+
+
+class QueryCounter(object):
+    """Counts the queries run through Trac's cursor wrapper."""
+
+    def __init__(self):
+        self.count = 0
+        self._execute = IterableCursor.execute
+        self._executemany = IterableCursor.executemany
+
+    def install(self):
+        counter = self
+        def execute(cursor, *args, **kwargs):
+            counter.count += 1
+            return counter._execute(cursor, *args, **kwargs)
+        def executemany(cursor, *args, **kwargs):
+            counter.count += 1
+            return counter._executemany(cursor, *args, **kwargs)
+        IterableCursor.execute = execute
+        IterableCursor.executemany = executemany
+
+    def uninstall(self):
+        IterableCursor.execute = self._execute
+        IterableCursor.executemany = self._executemany
+
+
+def create_env(path, n, links, closure):
+    """Create an environment with tickets 1..n linked by `links`, and a
+    spare unlinked ticket n+1."""
+    env = Environment(path, create=True, options=[
+        ('trac', 'database', 'sqlite:db/trac.db'),
+        ('components', 'mastertickets.*', 'enabled'),
+        ('mastertickets', 'use_closure', str(closure)),
+        ('ticket-custom', 'blocking', 'text'),
+        ('ticket-custom', 'blockedby', 'text'),
+    ])
+    db = env.get_db_cnx()
+    cursor = db.cursor()
+    now = to_utimestamp(datetime.now(utc))
+    cursor.executemany("INSERT INTO ticket (id, type, time, changetime, component, "
+                       "priority, owner, reporter, milestone, status, summary) "
+                       "VALUES (%s, 'defect', %s, %s, 'component1', 'major', %s, "
+                       "'bench', %s, %s, %s)",
+                       [(i, now, now, 'user%d' % (i % 10), 'milestone%d' % (i // 500),
+                         i % 3 and 'new' or 'closed',
+                         'Synthetic ticket number %d used by the benchmarks' % i)
+                        for i in xrange(1, n + 2)])
+    cursor.executemany('INSERT INTO mastertickets (source, dest) VALUES (%s, %s)', links)
+    rebuild_link_fields(db, xrange(1, n + 1))
+    rebuild_blocker_counts(db)
+    if closure:
+        rebuild_closure(db)
+    db.commit()
+    return env
+
+
+def benchmarks(env, n, links, focus):
+    """Return `[(name, function)]` for the benchmarks to run."""
+    req = Mock(href=Href('/trac'), abs_href=Href('http://example.org/trac'),
+               base_url='http://example.org/trac', authname='bench',
+               perm=MockPerm(), args={}, session={}, tz=utc, locale=None)
+    formatter = Mock(req=req, href=req.href)
+    system = MasterTicketsSystem(env)
+    module = MasterTicketsModule(env)
+    macros = MasterTicketsMacros(env)
+    graph = module._build_graph(req, focus)
+
+    blocking = [dest for source, dest in links if source == focus][:5]
+    blocked_by = [source for source, dest in links if dest == focus][:5]
+    far = n - focus > focus and n or 1
+    spare = n + 1
+    saves = [0]
+    def save():
+        # Alternately add and remove a link from the spare ticket
+        tkt_links = TicketLinks(env, focus)
+        if spare in tkt_links.blocked_by:
+            tkt_links.blocked_by.discard(spare)
+        else:
+            tkt_links.blocked_by.add(spare)
+        saves[0] += 1
+        when = datetime(2000, 1, 1, tzinfo=utc) + timedelta(seconds=saves[0])
+        tkt_links.save('bench', 'Benchmark', when)
+    linked = set(links)
+    targets = [i for i in xrange(n, focus, -1) if (focus, i) not in linked]
+    def relink():
+        # Alternately add and remove a link to a later ticket, which changes
+        # the closure of the focus ticket and all of its ancestors
+        tkt_links = TicketLinks(env, focus)
+        if targets[0] in tkt_links.blocking:
+            tkt_links.blocking.discard(targets[0])
+        else:
+            tkt_links.blocking.add(targets[0])
+        saves[0] += 1
+        when = datetime(2000, 1, 1, tzinfo=utc) + timedelta(seconds=saves[0])
+        tkt_links.save('bench', 'Benchmark', when)
+    def validate():
+        # Blocked by a ticket at the far end of the graph
+        tkt = Ticket(env, focus)
+        tkt['blockedby'] = ', '.join([str(x) for x in blocked_by + [far]])
+        return list(system.validate_ticket(req, tkt))
+    def expand_macro():
+        macros._memo.clear()
+        return macros.expand_macro(formatter, 'DepGraph', 'milestone=milestone0')
+
+    cases = [
+        ('TicketLinks.__init__', lambda: TicketLinks(env, focus)),
+        ('TicketLinks.walk', lambda: list(TicketLinks(env, focus).walk())),
+        ('TicketLinks.save', save),
+        ('MasterTicketsSystem.validate_ticket', validate),
+        ('MasterTicketsModule._build_graph', lambda: module._build_graph(req, focus)),
+        ('Graph.__str__', graph.__str__),
+        ('MasterTicketsMacros.expand_macro', expand_macro),
+        ('find_cycle', lambda: find_cycle(env, focus, blocking + [far], blocked_by)),
+    ]
+    if env.config.getbool('mastertickets', 'use_closure'):
+        cases.append(('find_cycle (closure)',
+                      lambda: find_cycle(env, focus, blocking + [far], blocked_by,
+                                         closure=True)))
+        if targets:
+            cases.append(('TicketLinks.save (closure)', relink))
+    return cases
+
+
+def run(func, repeat, counter):
+    func() # Warm up caches and lazily loaded state
+    times = []
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for i in xrange(repeat):
+        counter.count = 0
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    queries = counter.count
+    times.sort()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'queries': queries,
+        'peak_rss_kb': peak,
+        'rss_growth_kb': peak - rss,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print the benchmarks that got slower than in `baseline`, and return
+    whether there were any."""
+    regressed = False
+    for name, result in sorted(results.iteritems()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        ratio = base['median'] and result['median'] / base['median'] or 1.0
+        if ratio > 1 + tolerance or result['queries'] > base['queries']:
+            regressed = True
+            print 'REGRESSION %-40s %.4fs -> %.4fs (%+.0f%%), %d -> %d queries' % \
+                  (name, base['median'], result['median'], (ratio - 1) * 100,
+                   base['queries'], result['queries'])
+    return regressed
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--topology', type='choice', choices=sorted(TOPOLOGIES), default='chain',
+                      help='one of %s (default: %%default)' % ', '.join(sorted(TOPOLOGIES)))
+    parser.add_option('--tickets', type='int', default=1000,
+                      help='number of tickets (default: %default)')
+    parser.add_option('--degree', type='int', default=3,
+                      help='links per ticket for the dag topology (default: %default)')
+    parser.add_option('--seed', type='int', default=1,
+                      help='random seed (default: %default)')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='timed runs per benchmark (default: %default)')
+    parser.add_option('--closure', action='store_true', default=False,
+                      help='enable use_closure and also time closure lookups '
+                           'and updates')
+    parser.add_option('--output', metavar='FILE', help='write the results to FILE')
+    parser.add_option('--baseline', metavar='FILE',
+                      help='compare the results against FILE')
+    parser.add_option('--tolerance', type='float', default=0.2,
+                      help='allowed slowdown against the baseline (default: %default)')
+    options, args = parser.parse_args(args)
+
+    links, focus = TOPOLOGIES[options.topology](options.tickets,
+                                                random.Random(options.seed),
+                                                options.degree)
+    path = tempfile.mkdtemp(prefix='mastertickets-bench-')
+    counter = QueryCounter()
+    try:
+        start = time.time()
+        env = create_env(os.path.join(path, 'env'), options.tickets, links,
+                         options.closure)
+        print 'Created %d tickets with %d links in %.1fs' % \
+              (options.tickets, len(links), time.time() - start)
+        counter.install()
+        results = {}
+        for name, func in benchmarks(env, options.tickets, links, focus):
+            results[name] = result = run(func, options.repeat, counter)
+            print '%-40s %9.4fs %9.4fs %6d queries %8d KB' % \
+                  (name, result['min'], result['median'], result['queries'],
+                   result['rss_growth_kb'])
+    finally:
+        counter.uninstall()
+        shutil.rmtree(path, ignore_errors=True)
+
+    report = {
+        'python': sys.version.split()[0],
+        'trac': trac.__version__,
+        'topology': options.topology,
+        'tickets': options.tickets,
+        'links': len(links),
+        'closure': options.closure,
+        'repeat': options.repeat,
+        'results': results,
+    }
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(report, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    if options.baseline:
+        f = open(options.baseline)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        if (baseline['topology'], baseline['tickets']) != (options.topology, options.tickets):
+            print 'Warning: the baseline was taken with %s/%d' % \
+                  (baseline['topology'], baseline['tickets'])
+        if compare(results, baseline['results'], options.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""Memory and serialization benchmarks for `mastertickets.graphviz`.
+
+Builds graphs shaped like large dependency graphs, with the attributes the
+depgraph page sets on each node, and reports for each size the time to
+build the graph and to write its DOT source with `iter_dot`, and how much
+the process' peak memory grew during each. Each size runs in its own
+process, so the peaks do not hide each other::
+
+    python benchmarks/graph.py --edges 10000,100000
+"""
+import os
+import resource
+import subprocess
+import sys
+import time
+from optparse import OptionParser, SUPPRESS_HELP
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def build(graphviz, edges, degree):
+    g = graphviz.Graph()
+    g['node']['style'] = 'filled'
+    g['edge']['style'] = ''
+    nodes = edges // degree + 1
+    for i in xrange(1, nodes + 1):
+        node = g[i]
+        node['label'] = u'#%s' % i
+        node['URL'] = u'/trac/ticket/%s' % i
+        node['alt'] = u'Ticket #%s' % i
+        node['fillcolor'] = i % 3 and 'red' or 'green'
+        node['tooltip'] = u'Synthetic ticket number %d' % i
+    n = 0
+    for i in xrange(1, nodes + 1):
+        for j in xrange(1, degree + 1):
+            if n >= edges:
+                break
+            g[i] > g[(i * 7 + j * 13) % nodes + 1]
+            n += 1
+    return g
+
+
+def measure(edges, degree):
+    from mastertickets import graphviz
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    g = build(graphviz, edges, degree)
+    built = time.time() - start
+    grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    rss += grown
+    start = time.time()
+    size = 0
+    for chunk in g.iter_dot():
+        size += len(chunk)
+    written = time.time() - start
+    write_grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    print '%8d edges %8.3fs build %8.3fs write %8d KB graph %6d KB write %8d KB dot' % \
+          (edges, built, written, grown, write_grown, size // 1024)
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--edges', default='10000,100000',
+                      help='comma separated graph sizes (default: %default)')
+    parser.add_option('--degree', type='int', default=4,
+                      help='edges per node (default: %default)')
+    parser.add_option('--single', action='store_true', help=SUPPRESS_HELP)
+    options, args = parser.parse_args(args)
+    sizes = [int(n) for n in options.edges.split(',')]
+    if options.single:
+        measure(sizes[0], options.degree)
+        return 0
+    for edges in sizes:
+        subprocess.check_call([sys.executable, __file__, '--single',
+                               '--edges', str(edges), '--degree', str(options.degree)])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,360 @@
+import csv
+import sys
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from trac.admin.api import IAdminCommandProvider, AdminCommandError
+from trac.core import *
+from trac.util.compat import set, sorted
+from trac.util.text import printout, printerr
+
+from model import rebuild_closure, update_closure, update_blocker_counts, \
+                  rebuild_link_fields, link_fields_in_range, bump_generation, \
+                  find_cycle, chunks, database_scheme
+
+
+class MasterTicketsAdminCommands(Component):
+    """trac-admin commands for the MasterTickets plugin."""
+
+    implements(IAdminCommandProvider)
+
+    FORMATS = ('csv', 'json')
+    IMPORT_BATCH_SIZE = 1000
+    RESYNC_CHUNK_SIZE = 1000
+    RESYNC_WORKERS = 4
+
+    # IAdminCommandProvider methods
+    def get_admin_commands(self):
+        yield ('mastertickets closure rebuild', '',
+               'Recompute the transitive closure of all ticket links',
+               None, self._do_closure_rebuild)
+        yield ('mastertickets export', '<csv|json> [file]',
+               """Export all ticket links
+
+               Writes one `source,dest` row per link, or one JSON object per
+               line with the `json` format, to `file` or standard output.
+               """,
+               self._complete_format, self._do_export)
+        yield ('mastertickets import', '<csv|json> <file>',
+               """Import ticket links
+
+               Reads links in the format written by `mastertickets export`
+               from `file`, or standard input if `file` is `-`. Links to
+               missing tickets, links that already exist and links that
+               would create a dependency cycle are skipped. Each batch of
+               links is committed together with the `blocking` and
+               `blockedby` fields, blocker counts and closure of the
+               affected tickets, without adding to the ticket history.
+               """,
+               self._complete_format, self._do_import)
+        yield ('mastertickets resync', '[--dry-run] [first] [last]',
+               """Rebuild the link fields of tickets from the links table
+
+               Recomputes the `blocking` and `blockedby` fields of every
+               ticket, or of the tickets with ids from `first` to `last`,
+               and fixes those that differ. Fields listing more than
+               `hub_link_threshold` tickets are set to `*`. With `--dry-run`
+               the differences are only reported.
+               """,
+               None, self._do_resync)
+
+    # Internal methods
+    def _complete_format(self, args):
+        if len(args) == 1:
+            return self.FORMATS
+
+    def _check_format(self, format):
+        if format not in self.FORMATS:
+            raise AdminCommandError('Unknown format "%s", use one of %s' %
+                                    (format, ', '.join(self.FORMATS)))
+
+    def _do_closure_rebuild(self):
+        db = self.env.get_db_cnx()
+        rows = rebuild_closure(db)
+        db.commit()
+        printout('Rebuilt the link closure with %d rows' % rows)
+
+    def _do_export(self, format, filename=None):
+        self._check_format(format)
+        if filename:
+            out = open(filename, 'wb')
+        else:
+            out = sys.stdout
+        try:
+            db = self.env.get_read_db()
+            cursor = db.cursor()
+            cursor.execute('SELECT source, dest FROM mastertickets ORDER BY source, dest')
+            if format == 'csv':
+                writer = csv.writer(out)
+                writer.writerow(['source', 'dest'])
+                for source, dest in cursor:
+                    writer.writerow([int(source), int(dest)])
+            else:
+                for source, dest in cursor:
+                    out.write(json.dumps({'source': int(source), 'dest': int(dest)}) + '\n')
+        finally:
+            if filename:
+                out.close()
+
+    def _do_import(self, format, filename):
+        self._check_format(format)
+        if filename == '-':
+            f = sys.stdin
+        else:
+            f = open(filename, 'rb')
+        try:
+            self._import_links(self._read_links(f, format))
+        finally:
+            if filename != '-':
+                f.close()
+
+    def _do_resync(self, *args):
+        dry_run = '--dry-run' in args
+        args = [arg for arg in args if arg != '--dry-run']
+        try:
+            bounds = [int(arg) for arg in args]
+        except ValueError:
+            raise AdminCommandError('Invalid ticket id range %s' % ' '.join(args))
+        if len(bounds) > 2:
+            raise AdminCommandError('Too many arguments')
+        first = bounds and bounds[0] or 0
+        last = len(bounds) > 1 and bounds[1] or None
+
+        start = time.time()
+        ranges = list(self._id_ranges(first, last))
+        # SQLite only allows one writer at a time
+        if database_scheme(self.env) == 'sqlite':
+            workers = 1
+        else:
+            workers = min(self.RESYNC_WORKERS, len(ranges))
+        mismatches = self._resync_ranges(ranges, workers, dry_run)
+
+        mismatches.sort()
+        for n, field, old, new in mismatches:
+            printout('#%s %s: "%s" should be "%s"' % (n, field, old, new))
+        tickets = len(set([m[0] for m in mismatches]))
+        printout('%s %d fields of %d tickets in %.1fs' %
+                 (dry_run and 'Found differences in' or 'Fixed', len(mismatches),
+                  tickets, time.time() - start))
+
+    def _id_ranges(self, first, last):
+        """Yield `(first, last)` ranges of ticket ids, each holding at most
+        `RESYNC_CHUNK_SIZE` tickets."""
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        sql = 'SELECT id FROM ticket WHERE id>=%s'
+        if last is not None:
+            sql += ' AND id<=%d' % last
+        sql += ' ORDER BY id LIMIT %d' % self.RESYNC_CHUNK_SIZE
+        while True:
+            cursor.execute(sql, (first,))
+            ids = [int(n) for n, in cursor.fetchall()]
+            if not ids:
+                return
+            yield ids[0], ids[-1]
+            first = ids[-1] + 1
+
+    def _resync_ranges(self, ranges, workers, dry_run):
+        """Resync `ranges` using `workers` threads, each with its own
+        database connection, and return the mismatches found."""
+        lock = threading.Lock()
+        ranges = list(ranges)
+        ranges.reverse()
+        mismatches = []
+        errors = []
+        def work():
+            db = self.env.get_db_cnx()
+            try:
+                while not errors:
+                    lock.acquire()
+                    try:
+                        if not ranges:
+                            return
+                        first, last = ranges.pop()
+                    finally:
+                        lock.release()
+                    found = self._resync_range(db, first, last, dry_run)
+                    lock.acquire()
+                    try:
+                        mismatches.extend(found)
+                    finally:
+                        lock.release()
+            except Exception, e:
+                errors.append(e)
+            finally:
+                db.close()
+        if workers <= 1:
+            work()
+        else:
+            threads = [threading.Thread(target=work) for i in xrange(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        return mismatches
+
+    def _resync_range(self, db, first, last, dry_run):
+        cursor = db.cursor()
+        values = link_fields_in_range(db, first, last,
+                                      self.config.getint('mastertickets', 'hub_link_threshold', 0))
+        cursor.execute("SELECT ticket, name, value FROM ticket_custom "
+                       "WHERE name IN ('blocking', 'blockedby') AND ticket>=%s AND ticket<=%s",
+                       (first, last))
+        current = dict([((int(n), name), value) for n, name, value in cursor.fetchall()])
+
+        mismatches = []
+        updates = []
+        inserts = []
+        for n in sorted(values):
+            for field, value in zip(('blocking', 'blockedby'), values[n]):
+                old = current.get((n, field))
+                if (old or '') == value:
+                    continue
+                mismatches.append((n, field, old or '', value))
+                if old is None:
+                    inserts.append((n, field, value))
+                else:
+                    updates.append((value, n, field))
+        if not dry_run and mismatches:
+            if updates:
+                cursor.executemany('UPDATE ticket_custom SET value=%s WHERE ticket=%s AND name=%s',
+                                   updates)
+            if inserts:
+                cursor.executemany('INSERT INTO ticket_custom (ticket, name, value) VALUES (%s, %s, %s)',
+                                   inserts)
+            db.commit()
+        return mismatches
+
+    def _read_links(self, f, format):
+        """Yield `(source, dest)` for each valid row of `f`."""
+        if format == 'csv':
+            rows = csv.reader(f)
+        else:
+            rows = (line for line in f if line.strip())
+        for lineno, row in enumerate(rows):
+            try:
+                if format == 'json':
+                    row = json.loads(row)
+                    if isinstance(row, dict):
+                        row = (row['source'], row['dest'])
+                source, dest = row
+                yield int(source), int(dest)
+            except (ValueError, KeyError, TypeError), e:
+                if format == 'csv' and lineno == 0:
+                    continue # Header
+                printerr('Skipping invalid row %d: %r' % (lineno + 1, row))
+
+    def _import_links(self, links):
+        db = self.env.get_db_cnx()
+        start = time.time()
+        read = imported = 0
+        batch = []
+        for link in links:
+            batch.append(link)
+            if len(batch) >= self.IMPORT_BATCH_SIZE:
+                imported += self._import_batch(db, batch)
+                read += len(batch)
+                batch = []
+                elapsed = max(time.time() - start, 0.001)
+                printout('%d rows read, %d links imported (%d rows/s)' %
+                         (read, imported, read / elapsed))
+        if batch:
+            imported += self._import_batch(db, batch)
+            read += len(batch)
+        elapsed = max(time.time() - start, 0.001)
+        printout('Imported %d of %d links in %.1fs (%d rows/s)' %
+                 (imported, read, elapsed, read / elapsed))
+
+    def _import_batch(self, db, batch):
+        """Insert the valid links of `batch`, bring the state derived from
+        the links up to date and commit, so that an interrupted import leaves
+        a consistent database. Returns the number of links inserted."""
+        cursor = db.cursor()
+        links = []
+        seen = set()
+        for source, dest in batch:
+            if source == dest:
+                printerr('Skipping #%s -> #%s: a ticket cannot block itself' %
+                         (source, dest))
+            elif (source, dest) not in seen:
+                seen.add((source, dest))
+                links.append((source, dest))
+
+        ids = set([n for link in links for n in link])
+        existing = set()
+        for chunk in chunks(ids):
+            cursor.execute('SELECT id FROM ticket WHERE id IN (%s)' %
+                           ','.join(['%s'] * len(chunk)), chunk)
+            existing.update([int(n) for n, in cursor.fetchall()])
+        stored = set()
+        for chunk in chunks(set([source for source, dest in links])):
+            cursor.execute('SELECT source, dest FROM mastertickets WHERE source IN (%s)' %
+                           ','.join(['%s'] * len(chunk)), chunk)
+            stored.update([(int(s), int(d)) for s, d in cursor.fetchall()])
+
+        new_links = []
+        for source, dest in links:
+            missing = [n for n in (source, dest) if n not in existing]
+            if missing:
+                printerr('Skipping #%s -> #%s: ticket #%s does not exist' %
+                         (source, dest, missing[0]))
+            elif (source, dest) not in stored:
+                new_links.append((source, dest))
+        if not new_links:
+            return 0
+
+        # Insert the whole batch. A link can only be part of a cycle if its
+        # source is blocked by something and its dest blocks something; those
+        # are taken out again and added back one by one, so that the link
+        # closing a cycle is the one skipped.
+        cursor.executemany('INSERT INTO mastertickets (source, dest) VALUES (%s, %s)',
+                           new_links)
+        blocked = self._linked(cursor, 'dest', [source for source, dest in new_links])
+        blocking = self._linked(cursor, 'source', [dest for source, dest in new_links])
+        inserted = []
+        suspects = []
+        for source, dest in new_links:
+            if source in blocked and dest in blocking:
+                suspects.append((source, dest))
+            else:
+                inserted.append((source, dest))
+        if suspects:
+            cursor.executemany('DELETE FROM mastertickets WHERE source=%s AND dest=%s',
+                               suspects)
+        for source, dest in suspects:
+            path = find_cycle(self.env, None, [dest], [source], db)
+            if path is not None:
+                printerr('Skipping #%s -> #%s: it would create the cycle %s' %
+                         (source, dest, ' -> '.join(['#%s' % n for n in [source] + path])))
+            else:
+                cursor.execute('INSERT INTO mastertickets (source, dest) VALUES (%s, %s)',
+                               (source, dest))
+                inserted.append((source, dest))
+
+        if inserted:
+            sources = set([source for source, dest in inserted])
+            dests = set([dest for source, dest in inserted])
+            rebuild_link_fields(db, sources | dests,
+                                self.config.getint('mastertickets', 'hub_link_threshold', 0))
+            update_blocker_counts(db, dests)
+            generation = bump_generation(db)
+            if self.config.getbool('mastertickets', 'use_closure'):
+                update_closure(db, sources, generation)
+        db.commit()
+        return len(inserted)
+
+    def _linked(self, cursor, column, ids):
+        """Return the members of `ids` that appear in `column` of any link."""
+        found = set()
+        for chunk in chunks(set(ids)):
+            cursor.execute('SELECT DISTINCT %s FROM mastertickets WHERE %s IN (%s)' %
+                           (column, column, ','.join(['%s'] * len(chunk))), chunk)
+            found.update([int(n) for n, in cursor.fetchall()])
+        return found
@@ -1,17 +1,26 @@
 # Created by Noah Kantrowitz on 2007-07-04.
 # Copyright (c) 2007 Noah Kantrowitz. All rights reserved.
 import re
+import time
 
 from trac.core import *
 from trac.env import IEnvironmentSetupParticipant
-from trac.db import DatabaseManager
+from trac.db import DatabaseManager, Table, Column, Index
 from trac.ticket.api import ITicketChangeListener, ITicketManipulator
 from trac.util.compat import set, sorted
+from trac.config import BoolOption, IntOption
 
 import db_default
-from model import TicketLinks
+from index import DependencyIndex
+import request_cache
+from stats import MasterTicketsStats
+from prerender import GraphPrerenderer
+from model import TicketLinks, find_cycle, bump_generation, DATA_GENERATION_NAME, \
+                  update_blocker_counts, rebuild_blocker_counts, load_ticket_attrs, \
+                  HUB_FIELD_VALUE
 from trac.ticket.model import Ticket
 
+import admin
 import macro_provider
 
 class MasterTicketsSystem(Component):
@@ -19,12 +28,28 @@ class MasterTicketsSystem(Component):
 
     implements(IEnvironmentSetupParticipant, ITicketChangeListener, ITicketManipulator)
     
+    use_closure = BoolOption('mastertickets', 'use_closure', default=False,
+        doc='If enabled, maintain the transitive closure of all links in the '
+            '`mastertickets_closure` table and use it for reachability checks. '
+            'Run `trac-admin $ENV mastertickets closure rebuild` after enabling.')
+    
+    hub_link_threshold = IntOption('mastertickets', 'hub_link_threshold', default=0,
+        doc='When the `blocking` or `blockedby` field of a ticket would list '
+            'more tickets than this, it is set to `*` and its links are only '
+            'kept in the `mastertickets` table, so that changes to single '
+            'links do not rewrite the whole list. Set to 0 to disable.')
+    
     NUMBERS_RE = re.compile(r'\d+', re.U)
     
+    # Ticket fields shown or filtered on in dependency graphs
+    GRAPH_FIELDS = set(['summary', 'status', 'priority', 'milestone', 'component', 'owner'])
+    
     # IEnvironmentSetupParticipant methods
     def environment_created(self):
         self.found_db_version = 0
-        self.upgrade_environment(self.env.get_db_cnx())
+        db = self.env.get_db_cnx()
+        self.upgrade_environment(db)
+        db.commit()
         
     def environment_needs_upgrade(self, db):
         cursor = db.cursor()
@@ -47,48 +72,42 @@ class MasterTicketsSystem(Component):
         return False
             
     def upgrade_environment(self, db):
-        db_manager, _ = DatabaseManager(self.env)._get_connector()
-                
-        # Insert the default table
-        old_data = {} # {table_name: (col_names, [row, ...]), ...}
+        state = self._get_upgrade_state(db)
+        if state:
+            self.log.info('MasterTicketsSystem: Resuming upgrade of %s (%s)', *state)
+        migrations = [migration for vers, migration in db_default.migrations
+                      if self.found_db_version in vers]
+        for migration in migrations:
+            self.log.info('MasterTicketsSystem: Running migration %s', migration.__doc__)
+        
+        for tbl in db_default.tables:
+            introduced, changed = db_default.table_versions[tbl.name]
+            if state:
+                if tbl.name != state[0]:
+                    continue # Done before the upgrade was interrupted
+                step = state[1]
+                state = None
+            elif introduced > self.found_db_version:
+                step = 'create'
+            elif changed > self.found_db_version:
+                step = 'backup'
+            elif [v for v, columns in db_default.index_versions.get(tbl.name, ())
+                  if v > self.found_db_version]:
+                step = 'index'
+            else:
+                continue # Table is up to date
+            self._upgrade_table(db, tbl, step, migrations)
+        
         cursor = db.cursor()
         if not self.found_db_version:
             cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",(db_default.name, db_default.version))
         else:
             cursor.execute("UPDATE system SET value=%s WHERE name=%s",(db_default.version, db_default.name))
-            for tbl in db_default.tables:
-                try:
-                    cursor.execute('SELECT * FROM %s'%tbl.name)
-                    old_data[tbl.name] = ([d[0] for d in cursor.description], cursor.fetchall())
-                except Exception, e:
-                    if 'OperationalError' not in e.__class__.__name__:
-                        raise e # If it is an OperationalError, keep going
-                try:
-                    cursor.execute('DROP TABLE %s'%tbl.name)
-                except Exception, e:
-                    if 'OperationalError' not in e.__class__.__name__:
-                        raise e # If it is an OperationalError, just move on to the next table
+        self._set_upgrade_state(db, None)
 
-        for vers, migration in db_default.migrations:
-            if self.found_db_version in vers:
-                self.log.info('MasterTicketsSystem: Running migration %s', migration.__doc__)
-                migration(old_data)          
-                
-        for tbl in db_default.tables:
-            for sql in db_manager.to_sql(tbl):
-                cursor.execute(sql)
-                    
-            # Try to reinsert any old data
-            if tbl.name in old_data:
-                data = old_data[tbl.name]
-                sql = 'INSERT INTO %s (%s) VALUES (%s)' % \
-                      (tbl.name, ','.join(data[0]), ','.join(['%s'] * len(data[0])))
-                for row in data[1]:
-                    try:
-                        cursor.execute(sql, row)
-                    except Exception, e:
-                        if 'OperationalError' not in e.__class__.__name__:
-                            raise e
+        # Fill tables derived from the links
+        if self.found_db_version < 4:
+            rebuild_blocker_counts(db)
 
         custom = self.config['ticket-custom']
         config_dirty = False
@@ -108,10 +127,30 @@ class MasterTicketsSystem(Component):
         self.ticket_changed(tkt, '', tkt['reporter'], {})
 
     def ticket_changed(self, tkt, comment, author, old_values):
+        # The fields of the ticket changed since it was validated, and its
+        # links may have been changed by another request meanwhile, so the
+        # diff saved below must start from the links in the database
+        request_cache.invalidate([tkt.id])
         db = self.env.get_db_cnx()
         links = self._prepare_links(tkt, db)
         links.save(author, comment, tkt.time_changed, db)
+        self._clear_hub_fields(tkt, db)
+        if 'status' in old_values and \
+                (old_values['status'] == 'closed') != (tkt['status'] == 'closed'):
+            # The tickets this one blocks gained or lost an open blocker
+            update_blocker_counts(db, links.blocking)
+            request_cache.invalidate(links.blocking)
+        if self.GRAPH_FIELDS.intersection(old_values):
+            bump_generation(db, DATA_GENERATION_NAME)
         db.commit()
+        DependencyIndex(self.env).update(tkt.id, links.blocking, links.blocked_by,
+                                         links.generation)
+        if links.generation is not None or self.GRAPH_FIELDS.intersection(old_values):
+            # Warm the render cache for the graphs that show this ticket most
+            # prominently, including those of tickets that were unlinked
+            GraphPrerenderer(self.env).schedule(
+                set([tkt.id]) | links.blocking | links.blocked_by |
+                links._old_blocking | links._old_blocked_by)
 
     def ticket_deleted(self, tkt):
         db = self.env.get_db_cnx()
@@ -122,51 +161,239 @@ class MasterTicketsSystem(Component):
         links.save('trac', 'Ticket #%s deleted'%tkt.id, when=None, db=db)
         
         db.commit()
+        DependencyIndex(self.env).update(tkt.id, (), (), links.generation)
+        GraphPrerenderer(self.env).schedule(links._old_blocking | links._old_blocked_by)
         
     # ITicketManipulator methods
     def prepare_ticket(self, req, ticket, fields, actions):
         pass
 
     def validate_ticket(self, req, ticket):
+        stats = MasterTicketsStats(self.env)
+        scope = stats.start('validate_ticket', req)
+        try:
+            for error in self._validate_ticket(req, ticket):
+                yield error
+        finally:
+            stats.finish(scope)
+
+    # Internal methods
+    def _validate_ticket(self, req, ticket):
         db = self.env.get_db_cnx()
-        cursor = db.cursor()
         
-        id = unicode(ticket.id)
         links = self._prepare_links(ticket, db)
         
         # Check that ticket does not have itself as a blocker 
-        if id in links.blocking | links.blocked_by:
+        if ticket.id in links.blocking | links.blocked_by:
             yield 'blocked_by', 'This ticket is blocking itself'
             return
 
         # Check that there aren't any blocked_by in blocking or their parents
-        blocking = links.blocking.copy()
-        while len(blocking) > 0:
-            if len(links.blocked_by & blocking) > 0:
-                yield 'blocked_by', 'This ticket has circular dependencies'
-                return
-            new_blocking = set()
-            for link in blocking:
-                tmp_tkt = Ticket(self.env, link)
-                new_blocking |= TicketLinks(self.env, tmp_tkt, db).blocking
-            blocking = new_blocking
+        path = find_cycle(self.env, ticket.id, links.blocking, links.blocked_by, db,
+                          closure=self.use_closure)
+        if path is not None:
+            yield 'blocked_by', 'This ticket has circular dependencies: %s' % \
+                  ' blocks '.join(['this ticket'] + ['#%s' % n for n in path] +
+                                  ['this ticket'])
+            return
         
         for field in ('blocking', 'blockedby'):
             try:
                 ids = self.NUMBERS_RE.findall(ticket[field] or '')
-                for id in ids[:]:
-                    cursor.execute('SELECT id FROM ticket WHERE id=%s', (id,))
-                    row = cursor.fetchone()
-                    if row is None:
-                        ids.remove(id)
-                ticket[field] = ', '.join(sorted(ids, key=lambda x: int(x)))
+                existing = load_ticket_attrs(self.env, ids, (), db)
+                ids = [id for id in ids if int(id) in existing]
+                ids.sort(key=lambda x: int(x))
+                if HUB_FIELD_VALUE in (ticket[field] or ''):
+                    # Tickets added to a hub field until they are saved
+                    ids.insert(0, HUB_FIELD_VALUE)
+                ticket[field] = ', '.join(ids)
             except Exception, e:
                 self.log.debug('MasterTickets: Error parsing %s "%s": %s', field, ticket[field], e)
                 yield field, 'Not a valid list of ticket IDs'
 
-    # Internal methods
+    UPGRADE_STATE_NAME = 'mastertickets_upgrade'
+    UPGRADE_BATCH_SIZE = 1000
+    
+    def _upgrade_table(self, db, tbl, step, migrations):
+        """Bring `tbl` up to date, starting at `step`.
+        
+        New tables are simply created, and indexes added to a table are
+        created in place. Tables whose columns changed are copied to a
+        backup table, recreated and then refilled from the backup, in
+        batches that are committed as they go. The current table and step
+        are recorded in the `system` table before each step starts, so an
+        interrupted upgrade continues where it stopped when it is run again.
+        The original table is only dropped once the backup is complete.
+        """
+        db_manager, _ = DatabaseManager(self.env)._get_connector()
+        cursor = db.cursor()
+        backup = tbl.name + '_backup'
+        
+        if step == 'create':
+            self._set_upgrade_state(db, tbl.name, step)
+            cursor.execute('DROP TABLE IF EXISTS %s' % tbl.name)
+            for sql in db_manager.to_sql(tbl):
+                cursor.execute(sql)
+            return
+        
+        if step == 'index':
+            resumed = self._get_upgrade_state(db) == (tbl.name, step)
+            self._set_upgrade_state(db, tbl.name, step)
+            db.commit()
+            indexes = [Index(columns) for v, columns
+                       in db_default.index_versions.get(tbl.name, ())
+                       if v > self.found_db_version]
+            index_tbl = Table(tbl.name, key=tbl.key)[list(tbl.columns) + indexes]
+            for sql in db_manager.to_sql(index_tbl):
+                if 'INDEX' not in sql.upper().split()[:3]:
+                    continue # CREATE TABLE
+                try:
+                    cursor.execute(sql)
+                except Exception:
+                    if not resumed:
+                        raise
+                    # Created before the upgrade was interrupted
+                    db.rollback()
+                    cursor = db.cursor()
+            return
+        
+        if step == 'backup':
+            self._set_upgrade_state(db, tbl.name, step)
+            db.commit()
+            columns = self._table_columns(db, tbl.name)
+            types = dict([(c.name, c.type) for c in tbl.columns])
+            cursor.execute('DROP TABLE IF EXISTS %s' % backup)
+            backup_tbl = Table(backup, key=[k for k in tbl.key if k in columns])[
+                [Column(c, type=types.get(c, 'text')) for c in columns]]
+            for sql in db_manager.to_sql(backup_tbl):
+                cursor.execute(sql)
+            self._copy_rows(db, tbl.name, backup, columns, tbl.key)
+            step = 'recreate'
+        
+        if step == 'recreate':
+            # The backup is complete, so from here on it holds the only copy
+            # of the rows and is never dropped before they are restored
+            self._set_upgrade_state(db, tbl.name, step)
+            db.commit()
+            cursor.execute('DROP TABLE IF EXISTS %s' % tbl.name)
+            for sql in db_manager.to_sql(tbl):
+                cursor.execute(sql)
+            step = 'restore'
+            self._set_upgrade_state(db, tbl.name, step)
+            db.commit()
+        
+        if step == 'restore':
+            names = [c.name for c in tbl.columns]
+            columns = [c for c in self._table_columns(db, backup) if c in names]
+            def migrate(rows):
+                for migration in migrations:
+                    rows = migration(tbl.name, rows)
+                return rows
+            cursor.execute('SELECT COUNT(*) FROM %s' % tbl.name)
+            done = cursor.fetchone()[0]
+            self._copy_rows(db, backup, tbl.name, columns, tbl.key, migrate, done)
+            cursor.execute('DROP TABLE %s' % backup)
+    
+    def _copy_rows(self, db, src, dest, columns, key, migrate=None, skip=0):
+        """Copy `columns` from table `src` to table `dest` in batches ordered
+        by the `key` columns, committing after each batch.
+        
+        The first `skip` rows are assumed to have been copied already.
+        """
+        cursor = db.cursor()
+        key = [k for k in key if k in columns] or columns
+        key_idx = [columns.index(k) for k in key]
+        cursor.execute('SELECT COUNT(*) FROM %s' % src)
+        total = cursor.fetchone()[0]
+        
+        select = 'SELECT %s FROM %s' % (','.join(columns), src)
+        order = ' ORDER BY %s LIMIT %d' % (','.join(key), self.UPGRADE_BATCH_SIZE)
+        insert = 'INSERT INTO %s (%s) VALUES (%s)' % \
+                 (dest, ','.join(columns), ','.join(['%s'] * len(columns)))
+        
+        last = None
+        if skip:
+            cursor.execute('SELECT %s FROM %s ORDER BY %s LIMIT 1 OFFSET %d' %
+                           (','.join(key), src, ','.join(key), skip - 1))
+            last = cursor.fetchone()
+            self.log.info('MasterTicketsSystem: Skipping %d rows of %s copied '
+                          'before the upgrade was interrupted', skip, src)
+            if last is None:
+                return
+        
+        copied = skip
+        logged = time.time()
+        while True:
+            if last is None:
+                cursor.execute(select + order)
+            else:
+                # Keyset pagination: rows sorting after the last one copied
+                clauses = []
+                args = []
+                for i in xrange(len(key)):
+                    clauses.append('(%s)' % ' AND '.join(
+                        ['%s=%%s' % k for k in key[:i]] + ['%s>%%s' % key[i]]))
+                    args.extend(last[:i + 1])
+                cursor.execute(select + ' WHERE ' + ' OR '.join(clauses) + order, args)
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last = [rows[-1][i] for i in key_idx]
+            if migrate is not None:
+                rows = migrate(rows)
+            cursor.executemany(insert, rows)
+            db.commit()
+            
+            copied += len(rows)
+            if time.time() - logged >= 5 or len(rows) < self.UPGRADE_BATCH_SIZE:
+                self.log.info('MasterTicketsSystem: Copied %d of %d rows from %s to %s',
+                              copied, total, src, dest)
+                logged = time.time()
+            if len(rows) < self.UPGRADE_BATCH_SIZE:
+                break
+    
+    def _table_columns(self, db, table):
+        cursor = db.cursor()
+        cursor.execute('SELECT * FROM %s WHERE 1=0' % table)
+        return [d[0] for d in cursor.description]
+    
+    def _get_upgrade_state(self, db):
+        cursor = db.cursor()
+        cursor.execute("SELECT value FROM system WHERE name=%s",
+                       (self.UPGRADE_STATE_NAME,))
+        row = cursor.fetchone()
+        return row and tuple(row[0].split(':', 1)) or None
+    
+    def _set_upgrade_state(self, db, table, step=None):
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM system WHERE name=%s", (self.UPGRADE_STATE_NAME,))
+        if table:
+            cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",
+                           (self.UPGRADE_STATE_NAME, '%s:%s' % (table, step)))
+    
     def _prepare_links(self, tkt, db):
         links = TicketLinks(self.env, tkt, db)
-        links.blocking = set(int(n) for n in self.NUMBERS_RE.findall(tkt['blocking'] or ''))
-        links.blocked_by = set(int(n) for n in self.NUMBERS_RE.findall(tkt['blockedby'] or ''))
+        links.blocking = self._field_links(tkt['blocking'], links.blocking)
+        links.blocked_by = self._field_links(tkt['blockedby'], links.blocked_by)
         return links
+    
+    def _field_links(self, value, current):
+        """Return the links given by a `blocking` or `blockedby` field.
+        
+        A hub field, starting with `HUB_FIELD_VALUE`, keeps the `current`
+        links and adds the ids that follow it.
+        """
+        ids = set(int(n) for n in self.NUMBERS_RE.findall(value or ''))
+        if HUB_FIELD_VALUE in (value or ''):
+            ids |= current
+        return ids
+    
+    def _clear_hub_fields(self, tkt, db):
+        """Drop the ids added to the hub fields of `tkt` once they are saved
+        as links."""
+        cursor = db.cursor()
+        for field in ('blocking', 'blockedby'):
+            value = tkt[field] or ''
+            if HUB_FIELD_VALUE in value and value != HUB_FIELD_VALUE:
+                cursor.execute('UPDATE ticket_custom SET value=%s WHERE ticket=%s AND name=%s',
+                               (HUB_FIELD_VALUE, tkt.id, field))
@@ -1,22 +1,50 @@
 # Created by Noah Kantrowitz on 2007-07-04.
 # Copyright (c) 2007 Noah Kantrowitz. All rights reserved.
 
-from trac.db import Table, Column
+from trac.db import Table, Column, Index
 
 name = 'mastertickets'
-version = 2
+version = 5
 tables = [
     Table('mastertickets', key=('source','dest'))[
         Column('source', type='integer'),
         Column('dest', type='integer'),
+        Index(['dest']),
+    ],
+    Table('mastertickets_closure', key=('ancestor','descendant'))[
+        Column('ancestor', type='integer'),
+        Column('descendant', type='integer'),
+        Column('depth', type='integer'),
+        Index(['descendant']),
+    ],
+    Table('mastertickets_blockers', key='ticket')[
+        Column('ticket', type='integer'),
+        Column('open_blockers', type='integer'),
     ],
 ]
 
-def convert_to_int(data):
+# Schema versions each table was introduced in and its columns or key last
+# changed in. Tables changed since the installed version are rebuilt and
+# their rows copied over.
+table_versions = {
+    'mastertickets': (1, 2),
+    'mastertickets_closure': (3, 3),
+    'mastertickets_blockers': (4, 4),
+}
+
+# Indexes added to existing tables, as `[(version, columns)]`. They are
+# created in place unless the table is rebuilt anyway.
+index_versions = {
+    'mastertickets': [(5, ['dest'])],
+}
+
+# Migrations are called with a table name and each batch of rows copied into
+# the new table, and return the rows to insert in the same order.
+def convert_to_int(table, rows):
     """Convert both source and dest in the mastertickets table to ints."""
-    rows = data['mastertickets'][1]
-    for i, (n1, n2) in enumerate(rows):
-        rows[i] = [int(n1), int(n2)]
+    if table != 'mastertickets':
+        return rows
+    return [(int(n1), int(n2)) for n1, n2 in rows]
 
 migrations = [
     (xrange(1,2), convert_to_int),
@@ -2,26 +2,135 @@
 # Created by Noah Kantrowitz on 2007-12-21.
 # Copyright (c) 2007 Noah Kantrowitz. All rights reserved.
 import os
-import subprocess
 import tempfile
 import time
 import itertools
+import re
+from array import array
 
 try:
     set = set
 except NameError:
     from sets import Set as set
 
+def quote(value):
+    """Return `value` as a quoted DOT string."""
+    return u'"%s"'%unicode(value).replace(u'"', u'\\"').replace(u'\n', u'\\n')
+
+_RECORD_SPECIAL_RE = re.compile(r'([|<>{}])')
+
+def escape_record(text):
+    """Escape the characters of `text` that delimit fields in record labels."""
+    return _RECORD_SPECIAL_RE.sub(r'\\\1', text)
+
+def wrap(text, width):
+    """Word wrap `text`, starting a new line before any word that would
+    make a line `width` characters or longer. Existing line breaks and
+    most spaces are kept."""
+    words = text.split(' ')
+    parts = [words[0]]
+    line = len(words[0]) - words[0].rfind('\n') - 1
+    for word in words[1:]:
+        if line + len(word.split('\n', 1)[0]) >= width:
+            parts.append('\n')
+            line = 0
+        else:
+            parts.append(' ')
+            line += 1
+        parts.append(word)
+        if '\n' in word:
+            line = len(word) - word.rfind('\n') - 1
+        else:
+            line += len(word)
+    return ''.join(parts)
+
+def _format_attrs(attrs):
+    return u', '.join([u'%s=%s'%(k, quote(v)) for k, v in attrs.iteritems()])
+
 def _format_options(base_string, options):
-    return u'%s [%s]'%(base_string, u', '.join([u'%s="%s"'%x for x in options.iteritems()]))
+    return u'%s [%s]'%(base_string, _format_attrs(options))
+
+class _Attributes(object):
+    """Dictionary-like access to the attributes of a node or an edge, which
+    are kept by its graph.
+    
+    Only the attributes set on the object itself are seen this way. Its
+    `template`, a dictionary shared by many nodes or edges, is written
+    before them, so they override it.
+    """
+
+    __slots__ = ()
+
+    def _store(self, create=False):
+        raise NotImplementedError
+
+    def __getitem__(self, key):
+        attrs = self._store()
+        if attrs is None:
+            raise KeyError(key)
+        return attrs[key]
+
+    def __setitem__(self, key, value):
+        self._store(True)[key] = value
+
+    def __delitem__(self, key):
+        attrs = self._store()
+        if attrs is None:
+            raise KeyError(key)
+        del attrs[key]
 
-class Edge(dict):
-    """Model for an edge in a dot graph."""
+    def __contains__(self, key):
+        attrs = self._store()
+        return attrs is not None and key in attrs
 
-    def __init__(self, source, dest, **kwargs):
-        self.source = source
-        self.dest = dest
-        dict.__init__(self, **kwargs)
+    def __len__(self):
+        return len(self._store() or ())
+
+    def get(self, key, default=None):
+        return (self._store() or {}).get(key, default)
+
+    def keys(self):
+        return (self._store() or {}).keys()
+
+    def items(self):
+        return (self._store() or {}).items()
+
+    def iteritems(self):
+        return (self._store() or {}).iteritems()
+
+    def update(self, *args, **kwargs):
+        self._store(True).update(*args, **kwargs)
+
+
+class Edge(_Attributes):
+    """Model for an edge in a dot graph, the `index` of its ends in the
+    edge arrays of `graph`."""
+
+    __slots__ = ('graph', 'index')
+
+    def __init__(self, graph, index):
+        self.graph = graph
+        self.index = index
+
+    def source(self):
+        return Node(self.graph, self.graph._sources[self.index])
+    source = property(source)
+
+    def dest(self):
+        return Node(self.graph, self.graph._dests[self.index])
+    dest = property(dest)
+
+    def template(self):
+        return self.graph._edge_templates.get(self.index)
+    def _set_template(self, template):
+        self.graph._edge_templates[self.index] = template
+    template = property(template, _set_template)
+
+    def _store(self, create=False):
+        attrs = self.graph._edge_attrs.get(self.index)
+        if attrs is None and create:
+            attrs = self.graph._edge_attrs[self.index] = {}
+        return attrs
 
     def __str__(self):
         ret = u'%s -> %s'%(self.source.name, self.dest.name)
@@ -29,17 +138,50 @@ class Edge(dict):
             ret = _format_options(ret, self)
         return ret
 
+    def __eq__(self, other):
+        return isinstance(other, Edge) and other.graph is self.graph and \
+               other.index == self.index
+
+    def __ne__(self, other):
+        return not self == other
+
     def __hash__(self):
-        return hash(id(self))
+        return hash((id(self.graph), self.index))
+
+
+class Node(_Attributes):
+    """Model for a node in a dot graph, the integer `id` of a node of
+    `graph`."""
+
+    __slots__ = ('graph', 'id')
 
+    def __init__(self, graph, id):
+        self.graph = graph
+        self.id = id
 
-class Node(dict):
-    """Model for a node in a dot graph."""
+    def name(self):
+        return self.graph._names[self.id]
+    name = property(name)
 
-    def __init__(self, name, **kwargs):
-        self.name = unicode(name)
-        self.edges = []
-        dict.__init__(self, **kwargs)
+    def edges(self):
+        """The edges from and to this node. This scans every edge of the
+        graph."""
+        g = self.graph
+        return [Edge(g, i) for i in xrange(len(g._sources))
+                if self.id in (g._sources[i], g._dests[i])]
+    edges = property(edges)
+
+    def template(self):
+        return self.graph._node_templates[self.id]
+    def _set_template(self, template):
+        self.graph._node_templates[self.id] = template
+    template = property(template, _set_template)
+
+    def _store(self, create=False):
+        attrs = self.graph._node_attrs[self.id]
+        if attrs is None and create:
+            attrs = self.graph._node_attrs[self.id] = {}
+        return attrs
 
     def __str__(self):
         ret = self.name
@@ -49,94 +191,201 @@ class Node(dict):
 
     def __gt__(self, other):
         """Allow node1 > node2 to add an edge."""
-        edge = Edge(self, other)
-        self.edges.append(edge)
-        other.edges.append(edge)
-        return edge
+        return self.graph._add_edge(self, other)
 
     def __lt__(self, other):
-        edge = Edge(other, self)
-        self.edges.append(edge)
-        other.edges.append(edge)
-        return edge
+        return self.graph._add_edge(other, self)
+
+    def __eq__(self, other):
+        return isinstance(other, Node) and other.graph is self.graph and \
+               other.id == self.id
+
+    def __ne__(self, other):
+        return not self == other
 
     def __hash__(self):
-        return hash(id(self))
+        return hash((id(self.graph), self.id))
+
+
+class Subgraph(object):
+    """A subgraph of a `Graph`, e.g. a cluster, with its attributes in
+    `attrs`. `sub[key]` returns the node `key` of the graph and places it
+    in the subgraph."""
+
+    __slots__ = ('graph', 'index', 'name', 'attrs')
+
+    def __init__(self, graph, index, name, attrs):
+        self.graph = graph
+        self.index = index
+        self.name = name
+        self.attrs = attrs
+
+    def __getitem__(self, key):
+        node = self.graph[key]
+        self.graph._node_subgraphs[node.id] = self.index
+        return node
 
 
 class Graph(object):
-    """A model object for a graphviz digraph."""
+    """A model object for a graphviz digraph.
+    
+    Nodes are numbered in the order they are created. Their names and
+    attributes are kept in lists indexed by that number, and each edge is a
+    pair of node numbers in two arrays, with a dictionary of attributes only
+    if it has any. `Node` and `Edge` objects are views on these. Attributes
+    shared by many nodes or edges go in a `template`, which is formatted
+    once per graph.
+    
+    `g['graph']`, `g['node']` and `g['edge']` are the dictionaries of
+    default attributes, written before all nodes and edges.
+    """
+
+    DEFAULTS = ('graph', 'node', 'edge')
 
     def __init__(self, name=u'graph'):
         super(Graph,self).__init__()
         self.name = name
-        self.nodes = []
-        self._node_map = {}
-        self.edges = []
+        self.defaults = dict([(kind, {}) for kind in self.DEFAULTS])
+        self._names = [] # node id -> name, None once deleted
+        self._ids = {} # key -> node id
+        self._node_attrs = [] # node id -> attributes or None
+        self._node_templates = [] # node id -> template or None
+        self._node_subgraphs = array('i') # node id -> subgraph index or -1
+        self._subgraphs = []
+        self._sources = array('i')
+        self._dests = array('i')
+        self._edge_attrs = {} # edge index -> attributes
+        self._edge_templates = {} # edge index -> template
+
+    def nodes(self):
+        return [Node(self, id) for id, name in enumerate(self._names)
+                if name is not None]
+    nodes = property(nodes)
+
+    def edges(self):
+        return [Edge(self, i) for i in xrange(len(self._sources))
+                if self._is_live(i)]
+    edges = property(edges)
+
+    def subgraph(self, name, **attrs):
+        """Add a subgraph, written after the nodes outside of any subgraph
+        and in the order the subgraphs are added."""
+        sub = Subgraph(self, len(self._subgraphs), name, attrs)
+        self._subgraphs.append(sub)
+        return sub
 
     def add(self, obj):
-        if isinstance(obj, Node):
-            self.nodes.append(obj)
-            self._node_map[obj.name] = obj
-        elif isinstance(obj, Edge):
-            self.edges.append(obj)
+        """Nodes and edges are added to their graph when they are created,
+        this only checks that `obj` belongs to this graph."""
+        if obj.graph is not self:
+            raise ValueError('%r belongs to another graph' % obj)
 
     def __getitem__(self, key):
-        key = unicode(key)
-        if key not in self._node_map:
-            new_node = Node(key)
-            self._node_map[key] = new_node
-            self.nodes.append(new_node)
-        return self._node_map[key]
+        id = self._ids.get(key)
+        if id is None:
+            if key in self.defaults:
+                return self.defaults[key]
+            name = unicode(key)
+            id = self._ids.get(name)
+            if id is None:
+                id = len(self._names)
+                self._names.append(name)
+                self._node_attrs.append(None)
+                self._node_templates.append(None)
+                self._node_subgraphs.append(-1)
+                self._ids[name] = id
+            # Later lookups of the same key skip the conversion
+            self._ids[key] = id
+        return Node(self, id)
 
     def __delitem__(self, key):
-        key = unicode(key)
-        node = self._node_map.pop(key)
-        self.nodes.remove(node)
+        """Remove a node along with its edges."""
+        id = self._ids[unicode(key)]
+        for k in [k for k, v in self._ids.iteritems() if v == id]:
+            del self._ids[k]
+        self._names[id] = None
+        self._node_attrs[id] = None
+        self._node_templates[id] = None
+
+    # Number of lines in each chunk yielded by iter_dot
+    CHUNK_LINES = 1000
 
     def __str__(self):
-        edges = []
-        nodes = []
-        
-        memo = set()
-        def process(lst):
-            for obj in lst:
-                if obj in memo:
-                    continue
-                memo.add(obj)
-                
-                if isinstance(obj, Node):
-                    nodes.append(obj)
-                    process(obj.edges)
-                elif isinstance(obj, Edge):
-                    edges.append(obj)
-                    if isinstance(obj.source, Node):
-                        process((obj.source,))
-                    if isinstance(obj.dest, Node):
-                        process((obj.dest,))
-        
-        process(self.nodes)
-        process(self.edges)
-        
-        lines = [u'digraph "%s" {'%self.name]
-        for obj in itertools.chain(nodes, edges):
-            lines.append(u'\t%s;'%obj)
-        lines.append(u'}')
-        return u'\n'.join(lines)
-
-    def render(self, dot_path='dot', format='png'):
-        """Render a dot graph."""
-        proc = subprocess.Popen([dot_path, '-T%s'%format], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        out, _ = proc.communicate(unicode(self).encode('utf8'))
-        return out
+        return u'\n'.join(self._iter_lines())
+
+    def iter_dot(self, encoding='utf8'):
+        """Yield the DOT source of the graph in encoded chunks of
+        `CHUNK_LINES` lines, without building the whole document."""
+        lines = []
+        for line in self._iter_lines():
+            lines.append(line)
+            if len(lines) >= self.CHUNK_LINES:
+                lines.append(u'')
+                yield u'\n'.join(lines).encode(encoding)
+                lines = []
+        lines.append(u'')
+        yield u'\n'.join(lines).encode(encoding)
+
+    def _iter_lines(self):
+        names = self._names
+        formatted = {} # id(template) -> formatted attributes
+        def statement(base, attrs, template):
+            parts = []
+            if template:
+                if id(template) not in formatted:
+                    formatted[id(template)] = _format_attrs(template)
+                parts.append(formatted[id(template)])
+            if attrs:
+                parts.append(_format_attrs(attrs))
+            if parts:
+                return u'%s [%s];'%(base, u', '.join(parts))
+            return u'%s;'%base
+
+        yield u'digraph %s {'%quote(self.name)
+        for kind in self.DEFAULTS:
+            if self.defaults[kind]:
+                yield u'\t%s;'%_format_options(kind, self.defaults[kind])
+        members = [[] for sub in self._subgraphs]
+        for n, attrs in enumerate(self._node_attrs):
+            if names[n] is None:
+                continue
+            if self._node_subgraphs[n] >= 0:
+                members[self._node_subgraphs[n]].append(n)
+                continue
+            yield u'\t' + statement(names[n], attrs, self._node_templates[n])
+        for sub, ids in zip(self._subgraphs, members):
+            yield u'\tsubgraph %s {'%quote(sub.name)
+            if sub.attrs:
+                yield u'\t\tgraph [%s];'%_format_attrs(sub.attrs)
+            for n in ids:
+                yield u'\t\t' + statement(names[n], self._node_attrs[n],
+                                          self._node_templates[n])
+            yield u'\t}'
+        edge_attrs = self._edge_attrs
+        edge_templates = self._edge_templates
+        for i, (source, dest) in enumerate(itertools.izip(self._sources, self._dests)):
+            if names[source] is None or names[dest] is None:
+                continue
+            yield u'\t' + statement(u'%s -> %s'%(names[source], names[dest]),
+                                    edge_attrs.get(i), edge_templates.get(i))
+        yield u'}'
+
+    def _add_edge(self, source, dest):
+        if source.graph is not self or dest.graph is not self:
+            raise ValueError('Cannot link nodes of different graphs')
+        self._sources.append(source.id)
+        self._dests.append(dest.id)
+        return Edge(self, len(self._sources) - 1)
+
+    def _is_live(self, i):
+        return self._names[self._sources[i]] is not None and \
+               self._names[self._dests[i]] is not None
 
 
 if __name__ == '__main__':
     g = Graph()
-    root = Node('me')
-    root > Node('them')
-    root < Node(u'Üs')
-    
-    g.add(root)
+    root = g['me']
+    root > g['them']
+    root < g[u'Üs']
     
-    print g.render()
\ No newline at end of file
+    print ''.join(g.iter_dot())
\ No newline at end of file
@@ -0,0 +1,23 @@
+$(function() {
+    // Load the links of a blocking or blockedby field not shown on the page
+    $('a.mastertickets-more').click(function() {
+        var more = $(this);
+        var rest = more.parent();
+        $.getJSON(more.attr('href'), function(page) {
+            $.each(page.tickets, function(i, tkt) {
+                rest.before(', ');
+                rest.before($('<a></a>').attr('href', tkt.href)
+                                        .attr('title', tkt.summary)
+                                        .addClass(tkt.status + ' ticket')
+                                        .text('#' + tkt.id));
+            });
+            if (page.next === null) {
+                rest.remove();
+            } else {
+                more.attr('href', more.attr('href').replace(/offset=\d+/, 'offset=' + page.next));
+                more.text((page.total - page.next) + ' more');
+            }
+        });
+        return false;
+    });
+});
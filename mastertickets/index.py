@@ -0,0 +1,120 @@
+import threading
+
+from trac.core import *
+from trac.util.compat import set
+
+from model import get_generation
+from stats import count
+
+
+class DependencyIndex(Component):
+    """In-memory forward and reverse adjacency for the `mastertickets` table.
+
+    The index is loaded lazily on first use and kept current by the change
+    listener hooks of `MasterTicketsSystem`. Every `TicketLinks.save` bumps a
+    generation counter in the `system` table, so changes made by another
+    process are noticed on the next lookup and trigger a full reload.
+    Updates build a new index instead of changing the one lookups may be
+    walking.
+    """
+
+    def __init__(self):
+        # Only taken to swap in a new index; lookups read `_index` as is
+        self._lock = threading.Lock()
+        self._index = None # (generation, blocking, blocked_by)
+
+    # Public methods
+    def walk(self, tkt_id, db=None):
+        """Return `{id: blocking}` for every ticket reachable directly above
+        or below `tkt_id`, including `tkt_id` itself."""
+        blocking, blocked_by = self._get(db)
+        ids = self._reachable(blocking, [tkt_id]) | \
+              self._reachable(blocked_by, [tkt_id])
+        count('walk_nodes', len(ids))
+        return dict((n, set(blocking.get(n, ()))) for n in ids)
+
+    def update(self, tkt_id, blocking, blocked_by, generation):
+        """Replace the links of `tkt_id` after a `TicketLinks.save`.
+
+        `generation` is the value the save bumped the counter to, or `None`
+        if nothing was written. If the index missed an intermediate
+        generation it is dropped and reloaded on next use.
+        """
+        if generation is None:
+            return
+        tkt_id = int(tkt_id)
+        self._lock.acquire()
+        try:
+            index = self._index
+            if index is None:
+                return
+            if generation != index[0] + 1:
+                self._index = None
+                return
+            # Lookups may still be walking the old dictionaries
+            new_blocking = dict(index[1])
+            new_blocked_by = dict(index[2])
+            self._replace(new_blocking, new_blocked_by, tkt_id, blocking)
+            self._replace(new_blocked_by, new_blocking, tkt_id, blocked_by)
+            self._index = (generation, new_blocking, new_blocked_by)
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        """Drop the index so that it is reloaded on next use."""
+        self._lock.acquire()
+        try:
+            self._index = None
+        finally:
+            self._lock.release()
+
+    # Internal methods
+    def _reachable(self, adjacency, ids):
+        seen = set(int(n) for n in ids)
+        queue = list(seen)
+        while queue:
+            for n in adjacency.get(queue.pop(), ()):
+                if n not in seen:
+                    seen.add(n)
+                    queue.append(n)
+        return seen
+
+    def _get(self, db):
+        db = db or self.env.get_read_db()
+        generation = get_generation(db)
+        index = self._index
+        if index is not None and index[0] == generation:
+            return index[1], index[2]
+        blocking = {}
+        blocked_by = {}
+        cursor = db.cursor()
+        cursor.execute('SELECT source, dest FROM mastertickets')
+        for source, dest in cursor:
+            source, dest = int(source), int(dest)
+            blocking.setdefault(source, set()).add(dest)
+            blocked_by.setdefault(dest, set()).add(source)
+        self._lock.acquire()
+        try:
+            # Another thread may have loaded or updated it meanwhile
+            if self._index is None or self._index[0] <= generation:
+                self._index = (generation, blocking, blocked_by)
+        finally:
+            self._lock.release()
+        self.log.debug('MasterTickets: Loaded dependency index at generation '
+                       '%s (%s tickets)', generation, len(blocking))
+        return blocking, blocked_by
+
+    def _replace(self, forward, reverse, tkt_id, new_ids):
+        new_ids = set(int(n) for n in new_ids)
+        # The sets are shared with the previous index, so replace rather
+        # than modify them
+        for n in forward.pop(tkt_id, set()) - new_ids:
+            ids = reverse.get(n, set()) - set([tkt_id])
+            if ids:
+                reverse[n] = ids
+            else:
+                reverse.pop(n, None)
+        if new_ids:
+            forward[tkt_id] = new_ids
+        for n in new_ids:
+            reverse[n] = reverse.get(n, set()) | set([tkt_id])
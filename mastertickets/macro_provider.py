@@ -1,15 +1,22 @@
 # Created by Ryan Davis and Russ Tyndall on 2010-09-30.
 # Copyright (c) 2010 Ryan Davis. All rights reserved.
-import time
+import threading
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 from trac.web.href import Href
 from trac.core import *
 from trac.env import IEnvironmentSetupParticipant
 from trac.db import DatabaseManager
 from trac.wiki.api import IWikiMacroProvider, parse_args
-from trac.wiki.formatter import Formatter
 from trac.ticket.model import Ticket
+from trac.util.datefmt import format_datetime, from_utimestamp
 from model import *
-from StringIO import StringIO
+import graphviz
+from render import GraphRenderer, RenderError
+from stats import MasterTicketsStats
+from genshi.builder import tag
 from genshi.core import Markup
 
 class Options:
@@ -22,6 +29,12 @@ class MasterTicketsMacros(Component):
 
     implements(IWikiMacroProvider)
 
+    # Number of expanded macros kept in memory
+    MEMO_SIZE = 100
+
+    # Number of wrapped labels kept in memory
+    LABEL_MEMO_SIZE = 10000
+
     DEFAULT_OPTIONS = {'unblocked_color':"#4ECDC4",
                 'unblocked_linkcolor':"blue",
                 'blocked_color':"black",
@@ -33,10 +46,20 @@ class MasterTicketsMacros(Component):
                 'fontsize':"12",
                 'show_ticket_number':"1",
                 'milestone':'',
+                'status':'',
+                'component':'',
+                'owner':'',
                 'group_by_milestone':'1',
                 'debug':'0',
-                'word_wrap_char_limit':'30'}
+                'word_wrap_char_limit':'30',
+                'timestamp':''}
+
 
+    def __init__(self):
+        self._memo_lock = threading.Lock()
+        self._memo = {} # {key: (stamp, html, render key, ticket ids, changed)}
+        self._memo_order = []
+        self._labels = {} # {(text, width): wrapped text}
 
     def get_macros(self):
         """Return an iterable that provides the names of the provided macros.
@@ -80,33 +103,67 @@ class MasterTicketsMacros(Component):
         extract arguments and name parameters from the `content` inside the
         parentheses, in the latter situation). (''since 0.12'')
         """
-        def escape(txt, chars):
-            if chars:
-                char = chars.pop()
-                return escape(txt.replace(char, '\\'+char), chars)
-            else:
-                return txt
-
-        # from http://code.activestate.com/recipes/148061-one-liner-word-wrap-function/
-        def wrap(text, width):
-            """
-            A word-wrap function that preserves existing line breaks
-            and most spaces in the text. Expects that existing line
-            breaks are posix newlines (\n).
-            """
-            return reduce(lambda line, word, width=width: '%s%s%s' %
-                          (line,
-                           ' \n'[(len(line)-line.rfind('\n')-1
-                                  + len(word.split('\n',1)[0]
-                                        ) >= width)],
-                           word),
-                          text.split(' ')
-                          )
+        stats = MasterTicketsStats(self.env)
+        scope = stats.start('expand_macro', formatter.req)
+        try:
+            return self._expand_memoized(formatter, content, args)
+        finally:
+            stats.finish(scope)
+
+    def recent(self):
+        """Return `(content, args, base_url, href_base)` for the macros in
+        the memo, least recently expanded first."""
+        self._memo_lock.acquire()
+        try:
+            keys = list(self._memo_order)
+        finally:
+            self._memo_lock.release()
+        return [(content, args and dict(args), base_url, href_base)
+                for content, args, base_url, href_base in keys]
+
+    def _expand_memoized(self, formatter, content, args):
+        db = self.env.get_read_db()
+        stamp = (get_generation(db), get_generation(db, DATA_GENERATION_NAME))
+        key = (content, args and tuple(sorted(args.items())), formatter.req.base_url,
+               formatter.href.base)
+
+        self._memo_lock.acquire()
+        try:
+            memo = self._memo.get(key)
+        finally:
+            self._memo_lock.release()
+        if memo is not None and memo[0] == stamp and \
+                GraphRenderer(self.env).has(memo[2]):
+            # The default label shows the time of the latest change to the
+            # graph's tickets, which even a comment moves
+            if memo[4] is None or last_changed(self.env, memo[3], db) == memo[4]:
+                return memo[1]
+
+        final, render_key, ids, changed = self._expand(formatter, content, args, key)
+        if render_key is not None:
+            self._memo_lock.acquire()
+            try:
+                if key not in self._memo and len(self._memo) >= self.MEMO_SIZE:
+                    del self._memo[self._memo_order.pop(0)]
+                if key in self._memo_order:
+                    self._memo_order.remove(key)
+                self._memo_order.append(key)
+                self._memo[key] = (stamp, final, render_key, ids, changed)
+            finally:
+                self._memo_lock.release()
+        return final
+
+    def _expand(self, formatter, content, args, memo_key):
+        """Build and render the dependency graph.
 
+        Returns the HTML, the render cache key of the image, which is `None`
+        if rendering failed, the ids of the tickets in the graph, and the
+        time of their latest change if the label shows it, else `None`.
+        """
         # http://www.colourlovers.com/palette/1930/cheer_up_emo_kid
         opts = MasterTicketsMacros.DEFAULT_OPTIONS.copy()
-        opts['label'] =  "as of %s" % time.asctime()
-        opts['graph_name'] = str(int(time.time()))
+        opts['label'] = None
+        opts['graph_name'] = 'depgraph_%s' % sha1(repr(memo_key)).hexdigest()[:8]
         
         if args == None and content:
             x,args = parse_args(content)
@@ -124,184 +181,156 @@ class MasterTicketsMacros(Component):
         for iopt in ['word_wrap_char_limit', 'fontsize']:
             opts[iopt] = int(opts[iopt])
 
-        word_wrap_char_limit = Options(**opts).word_wrap_char_limit
-        def q(txt):
-            return '"%s"' % escape(wrap(txt, word_wrap_char_limit), list('"')).replace('\n', '\\n')
-
-
-        # quote things we should quote
-        for o in ['unblocked_color','unblocked_linkcolor', 'blocked_color', 'blocked_linkcolor', 'closed_color', 'closed_linkcolor', 'critical_color', 'critical_linkcolor', 'label', 'graph_name']:
-            opts[o] = q(opts[o])
-
-        
         opts = Options(**opts)
 
+        def label(text):
+            return self._label(text, opts.word_wrap_char_limit)
 
 
 
-        opts.milestone = [x.lower() for x in opts.milestone.split('|') if len(x)>0]
 
-        def has_good_milestone(tkt):
-            if opts.milestone:
-                return tkt['milestone'] and tkt['milestone'].lower() in opts.milestone
-            else:
-                return True
+        filters = {}
+        for field in ('milestone', 'status', 'component', 'owner'):
+            values = [x.lower() for x in getattr(opts, field).split('|') if len(x)>0]
+            if values:
+                filters[field] = values
 
         tickets = {}
-        def ensure_ticket(tktid):
-            if not tickets.has_key(tktid):
-                tkt = Ticket(self.env, tktid)
-                if has_good_milestone(tkt):
-                    tickets[tktid] = tkt
-                    tickets[tktid]['mastertickets_blocking'] = set()
-            return tickets.get(tktid)
-
-        default_nodeopts = {'color': opts.blocked_color,
-                            'fontcolor':opts.blocked_linkcolor,
-                            'fontsize':opts.fontsize,
-                            'margin':'.15,.15'}
-
-        unblocked_attributes = {'color': opts.unblocked_color,
-                                'fontcolor':opts.unblocked_linkcolor,
-                                'style': "filled"}
-            
-        critical_attributes = {'color': opts.critical_color,
-                               'fontcolor':opts.critical_linkcolor,
-                               'style': "filled"}
-
-        closed_attributes = {'color': opts.closed_color,
-                             'fontcolor':opts.closed_linkcolor,
-                             'style': "filled"}
-
-        def write_node(writer, node_name, **attrs):
-            writer.write("%s [" % node_name)            
-            for k,v in attrs.items():
-                writer.write('%s=%s,' % (k, v))
-            writer.write("]\n")
-            
+        for tktid, summary, status, priority, milestone in \
+                linked_tickets(self.env, ('summary', 'status', 'priority', 'milestone'), filters):
+            tickets[tktid] = {'summary': summary, 'status': status,
+                              'priority': priority, 'milestone': milestone,
+                              'mastertickets_blocking': set()}
+
+        # Label the graph with the newest change unless told otherwise
+        changed = None
+        if not opts.timestamp and opts.label is None:
+            changed = last_changed(self.env, tickets)
+            opts.timestamp = changed and format_datetime(from_utimestamp(changed)) or ''
+        if opts.label is None:
+            opts.label = opts.timestamp and 'as of %s' % opts.timestamp or ''
+
+        # Shared by all nodes and edges in the same state, in place of
+        # per-node copies
+        legend_templates = {
+            'blocked': {},
+            'unblocked': {'color': opts.unblocked_color,
+                          'fontcolor': opts.unblocked_linkcolor, 'style': 'filled'},
+            'critical': {'color': opts.critical_color,
+                         'fontcolor': opts.critical_linkcolor, 'style': 'filled'},
+            'closed': {'color': opts.closed_color,
+                       'fontcolor': opts.closed_linkcolor, 'style': 'filled'},
+        }
+        templates = legend_templates
+        if opts.show_ticket_number:
+            templates = dict((state, dict(attrs, shape='record'))
+                             for state, attrs in legend_templates.items())
+        closed_edge = {'style': 'dashed', 'color': opts.closed_color}
 
         #parse args from content
         final = "error"
+        render_key = None
         try:
-            dot = StringIO()
-            dot.write("""digraph %s{
-  label=%s
-""" % (opts.graph_name, opts.label))
-            
-            write_node(dot, 'node', **default_nodeopts)
-
-            dot.write("""subgraph cluster0{
-  label="Legend"
-""")
-
-            write_node(dot, 'closed', label=q('Closed / Done'), **closed_attributes)
-            write_node(dot, 'unblocked', label=q('Unblocked / Ready'), **unblocked_attributes)
-            write_node(dot, 'critical', label=q('Active'), **critical_attributes)
-            write_node(dot, 'blocked', label=q('Blocked'))
-
-            dot.write("}")
-
-
-            blocked_ids = set()
+            blocked_ids = set(open_blocker_counts(self.env, tickets))
 
             #render the edges and build up some hashes we'll need for node rendering
-            for (src, dst) in all_links(self.env):
-                src_tkt = ensure_ticket(src)
-                dst_tkt = ensure_ticket(dst)
-
-                if src_tkt == None:
-                    continue
-                if dst_tkt != None:
-                    src_tkt['mastertickets_blocking'].add(dst)
-                    if src_tkt['status'] != 'closed':
-                        blocked_ids.add(dst)
-
-            edges = StringIO()
+            for (src, dst) in filtered_links(self.env, filters):
+                src_tkt = tickets.get(src)
+                if src_tkt is None or dst not in tickets:
+                    continue # Linked after the tickets were read
+                src_tkt['mastertickets_blocking'].add(dst)
+
+            g = graphviz.Graph(opts.graph_name)
+            g['graph']['label'] = label(opts.label)
+            g['node'].update({'color': opts.blocked_color,
+                              'fontcolor': opts.blocked_linkcolor,
+                              'fontsize': opts.fontsize,
+                              'margin': '.15,.15'})
+
+            legend = g.subgraph('cluster0', label='Legend')
+            for state, text in (('closed', 'Closed / Done'),
+                                ('unblocked', 'Unblocked / Ready'),
+                                ('critical', 'Active'), ('blocked', 'Blocked')):
+                node = legend[state]
+                node.template = legend_templates[state]
+                node['label'] = label(text)
+
             #render the nodes
             h = Href(formatter.req.base_url)
-
-            
-
-            def write_ticket_node(writer, tktid, tkt):
-                nodeopts = default_nodeopts.copy()
-                nodeopts['URL'] = q(h.ticket(tktid))
-
-                nodeopts['label'] = q(tkt['summary'])
-
-                if opts.show_ticket_number:
-                    nodeopts['shape'] = 'record'
-                    nodeopts['label'] = q('%s|%s' % (tktid, escape(tkt['summary'], list('|<>{}'))))
-
-
-                
-                # color differently if we're not blocked
-                if tktid not in blocked_ids:
-                    nodeopts.update(unblocked_attributes)
-
-                if tkt['priority'] == 'critical':
-                    nodeopts.update(critical_attributes)
-
-                # color differently if we're closed
+            if opts.group_by_milestone:
+                # Tickets without a milestone stay outside of the clusters
+                order = sorted(tickets.items(),
+                               key=lambda item: (item[1]['milestone'], item[0]))
+            else:
+                order = sorted(tickets.items())
+            clusters = {}
+            for (tktid, tkt) in order:
+                parent = g
+                if opts.group_by_milestone and tkt['milestone']:
+                    parent = clusters.get(tkt['milestone'])
+                    if parent is None:
+                        parent = clusters[tkt['milestone']] = g.subgraph(
+                            'cluster%s' % (len(clusters) + 1),
+                            label=label(tkt['milestone']))
+                node = parent['ticket%s' % tktid]
+
+                # color differently if we're closed, critical or not blocked
                 if tkt['status'] == 'closed':
-                    nodeopts.update(closed_attributes)
+                    node.template = templates['closed']
+                elif tkt['priority'] == 'critical':
+                    node.template = templates['critical']
+                elif tktid not in blocked_ids:
+                    node.template = templates['unblocked']
+                else:
+                    node.template = templates['blocked']
 
-                writer.write("ticket%s [" % tktid)
-                for k,v in nodeopts.items():
-                    writer.write('%s=%s,' % (k, v))
-                writer.write("]\n")
+                node['URL'] = h.ticket(tktid)
+                if opts.show_ticket_number:
+                    node['label'] = label('%s|%s' % (tktid, graphviz.escape_record(tkt['summary'])))
+                else:
+                    node['label'] = label(tkt['summary'])
 
-                for dst in tkt['mastertickets_blocking']:
-                    edges.write("ticket%s -> ticket%s" % (tktid, dst))
+            for (tktid, tkt) in sorted(tickets.items()):
+                node = g['ticket%s' % tktid]
+                for dst in sorted(tkt['mastertickets_blocking']):
+                    edge = node > g['ticket%s' % dst]
                     if tkt['status'] == 'closed':
-                        edges.write(" [style=dashed,color=%s]" % (opts.closed_color))
-                    edges.write('\n')
-
-            milestones = {}
+                        edge.template = closed_edge
 
-            def milestone_writer(milestone):
-                if not milestones.has_key(milestone):
-                    milestones[milestone] = StringIO()
-                return milestones[milestone]
-
-            for (tktid, tkt) in tickets.items():
-                writer = opts.group_by_milestone and milestone_writer(tkt['milestone']) or dot
-                write_ticket_node(writer, tktid, tkt)
-
-            
-
-            cluster = 1
-            for milestone,io in milestones.items():
-                if milestone == '':
-                    dot.write(io.getvalue())
-                else:
-                    dot.write("""
-subgraph cluster%s{
-  label=%s
-%s
-}
-""" % (cluster, q(milestone), io.getvalue()))
-                    cluster += 1
-
-            dot.write(edges.getvalue())
-            dot.write("}")
-
-            out = StringIO()
-            graphviz = StringIO()
-            graphviz.write("""{{{#!graphviz
-%s
-}}}""" % (dot.getvalue()))
+            renderer = GraphRenderer(self.env)
+            if renderer.use_gs:
+                key, cmapx = renderer.cache(g), None
+            else:
+                keys = renderer.cache_many(g, ['png', 'cmapx'])
+                key, cmapx = keys['png'], renderer.get(keys['cmapx'], 'cmapx')
+            render_key = key
+            usemap = None
+            if cmapx:
+                usemap = '#%s' % opts.graph_name
+            final = tag.div(tag.img(src=formatter.href.depgraph('render', key + '.png'),
+                                    alt='Dependency graph', usemap=usemap),
+                            class_='depgraph')
+            if cmapx:
+                final.append(Markup(cmapx.decode('utf8')))
             if opts.debug:
-                graphviz.write("""
-{{{
-%s
-}}}""" % (dot.getvalue()))
-
-            Formatter(formatter.env, formatter.context).format(graphviz.getvalue(), out)
-            final = Markup(out.getvalue())
+                final.append(tag.pre(''.join(g.iter_dot()).decode('utf8')))
+        except RenderError, e:
+            final = tag.div(unicode(e), class_='system-message')
         except Exception, e:
             self.log.exception('RPD%s', e)
             TracError(e)
             final = '%s' % (e)
-        return final
+        return final, render_key, list(tickets), changed
+
+    def _label(self, text, width):
+        """Return `text` word wrapped at `width`, memoized as the same
+        summaries are wrapped again on every expansion."""
+        key = (text, width)
+        label = self._labels.get(key)
+        if label is None:
+            if len(self._labels) >= self.LABEL_MEMO_SIZE:
+                self._labels.clear()
+            label = self._labels[key] = graphviz.wrap(text, width)
+        return label
    
  
@@ -3,21 +3,56 @@
 import copy
 from datetime import datetime
 
+from trac.ticket.api import TicketSystem
 from trac.ticket.model import Ticket
 from trac.util.compat import set, sorted
 from trac.util.datefmt import utc, to_utimestamp
 
-def all_links(env):
-    db = env.get_read_db()
-    cur = db.cursor()
-    data = None
-    try:
-        cur.execute('SELECT source, dest FROM mastertickets')
-        data = list(cur.fetchall())
-    except Exception, e:
-        env.log.exception('Error fetching list of ticket links: %s', e)
+from stats import count
+import request_cache
 
-    return data
+GENERATION_NAME = 'mastertickets_generation'
+DATA_GENERATION_NAME = 'mastertickets_data_generation'
+# The link generation mastertickets_closure was last brought up to date with
+CLOSURE_GENERATION_NAME = 'mastertickets_closure_generation'
+
+# Stored in the blocking or blockedby field of a ticket with more links than
+# hub_link_threshold, instead of the full list of ids
+HUB_FIELD_VALUE = '*'
+
+def get_generation(db, name=GENERATION_NAME):
+    """Return the current value of a generation counter.
+    
+    `GENERATION_NAME` counts changes to the links themselves,
+    `DATA_GENERATION_NAME` changes to ticket fields shown in graphs.
+    """
+    cursor = db.cursor()
+    cursor.execute('SELECT value FROM system WHERE name=%s', (name,))
+    row = cursor.fetchone()
+    return row and int(row[0]) or 0
+
+def bump_generation(db, name=GENERATION_NAME):
+    """Increment a generation counter and return the new value."""
+    cursor = db.cursor()
+    while True:
+        cursor.execute('SELECT value FROM system WHERE name=%s', (name,))
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute('INSERT INTO system (name, value) VALUES (%s, %s)',
+                           (name, '1'))
+            return 1
+        generation = int(row[0]) + 1
+        cursor.execute('UPDATE system SET value=%s WHERE name=%s AND value=%s',
+                       (str(generation), name, row[0]))
+        if cursor.rowcount:
+            return generation
+
+def _set_generation(db, name, generation):
+    cursor = db.cursor()
+    cursor.execute('UPDATE system SET value=%s WHERE name=%s', (str(generation), name))
+    if not cursor.rowcount:
+        cursor.execute('INSERT INTO system (name, value) VALUES (%s, %s)',
+                       (name, str(generation)))
     
 
 class TicketLinks(object):
@@ -29,21 +64,47 @@ class TicketLinks(object):
         self.env = env
         if not isinstance(tkt, Ticket):
             tkt = Ticket(self.env, tkt)
+            count('tickets')
         self.tkt = tkt
         
-        db = db or self.env.get_db_cnx()
-        cursor = db.cursor()
+        cache = request_cache.current()
+        if cache is not None and self.tkt.id in cache['links']:
+            blocking, blocked_by = cache['links'][self.tkt.id]
+        else:
+            db = db or self.env.get_db_cnx()
+            cursor = db.cursor()
+            
+            cursor.execute('SELECT source, dest FROM mastertickets WHERE source=%s OR dest=%s',
+                           (self.tkt.id, self.tkt.id))
+            blocking = set()
+            blocked_by = set()
+            for source, dest in cursor:
+                if source == self.tkt.id:
+                    blocking.add(int(dest))
+                if dest == self.tkt.id:
+                    blocked_by.add(int(source))
+            blocking = frozenset(blocking)
+            blocked_by = frozenset(blocked_by)
+            if cache is not None and self.tkt.id is not None:
+                cache['links'][self.tkt.id] = (blocking, blocked_by)
         
-        cursor.execute('SELECT dest FROM mastertickets WHERE source=%s ORDER BY dest', (self.tkt.id,))
-        self.blocking = set([int(num) for num, in cursor])
+        self.blocking = set(blocking)
         self._old_blocking = copy.copy(self.blocking)
-        
-        cursor.execute('SELECT source FROM mastertickets WHERE dest=%s ORDER BY source', (self.tkt.id,))
-        self.blocked_by = set([int(num) for num, in cursor])
+        self.blocked_by = set(blocked_by)
         self._old_blocked_by = copy.copy(self.blocked_by)
         
+        # Set by save() to the new link generation, if anything was written
+        self.generation = None
+        
     def save(self, author, comment='', when=None, db=None):
-        """Save new links."""
+        """Save new links.
+        
+        The `blocking` and `blockedby` fields of the linked tickets are
+        updated to match. A field holding `HUB_FIELD_VALUE` is left as it is
+        and only the added or removed id is recorded in the ticket's history,
+        and a field that would list more than `hub_link_threshold` tickets
+        is switched to `HUB_FIELD_VALUE`.
+        """
         if when is None:
             when = datetime.now(utc)
         when_ts = to_utimestamp(when)
@@ -63,52 +124,88 @@ class TicketLinks(object):
             (new_blocked_by, self._old_blocked_by, 'blocking', ('dest', 'source')),
         ]
         
+        if new_blocking != self._old_blocking or new_blocked_by != self._old_blocked_by:
+            self.generation = bump_generation(db)
+        
+        # Work out the full diff first, then apply it in bulk
+        tkt_id = str(self.tkt.id)
+        link_inserts = []
+        link_deletes = []
+        updates = {} # {field: {ticket: added}}
+        def link(sourcedest, n):
+            values = dict(zip(sourcedest, (self.tkt.id, n)))
+            return values['source'], values['dest']
         for new_ids, old_ids, field, sourcedest in to_check:
-            for n in new_ids | old_ids:
-                update_field = None
-                if n in new_ids and n not in old_ids:
-                    # New ticket added
-                    cursor.execute('INSERT INTO mastertickets (%s, %s) VALUES (%%s, %%s)'%sourcedest, (self.tkt.id, n))
-                    update_field = lambda lst: lst.append(str(self.tkt.id))
-                elif n not in new_ids and n in old_ids:
-                    # Old ticket removed
-                    cursor.execute('DELETE FROM mastertickets WHERE %s=%%s AND %s=%%s'%sourcedest, (self.tkt.id, n))
-                    update_field = lambda lst: lst.remove(str(self.tkt.id))
+            for n in new_ids - old_ids:
+                # New ticket added
+                link_inserts.append(link(sourcedest, n))
+                updates.setdefault(field, {})[n] = True
+            for n in old_ids - new_ids:
+                # Old ticket removed
+                link_deletes.append(link(sourcedest, n))
+                updates.setdefault(field, {})[n] = False
+        
+        if link_inserts:
+            cursor.executemany('INSERT INTO mastertickets (source, dest) VALUES (%s, %s)', link_inserts)
+        if link_deletes:
+            cursor.executemany('DELETE FROM mastertickets WHERE source=%s AND dest=%s', link_deletes)
+        if link_inserts or link_deletes:
+            request_cache.invalidate()
+            update_blocker_counts(db, set([dest for source, dest in link_inserts + link_deletes]))
+            if self.env.config.getbool('mastertickets', 'use_closure', False):
+                update_closure(db, set([source for source, dest in link_inserts + link_deletes]),
+                               self.generation)
+        
+        hub_threshold = self.env.config.getint('mastertickets', 'hub_link_threshold', 0)
+        changes = []
+        custom_updates = []
+        custom_inserts = []
+        commented = set()
+        for field, tickets in updates.iteritems():
+            old_values = {}
+            for chunk in chunks(tickets):
+                cursor.execute('SELECT ticket, value FROM ticket_custom WHERE name=%%s AND ticket IN (%s)' %
+                               ','.join(['%s'] * len(chunk)), [field] + chunk)
+                for n, value in cursor.fetchall():
+                    old_values[int(n)] = value
+            
+            for n in sorted(tickets):
+                if comment and n not in commented:
+                    changes.append((n, when_ts, author, 'comment', '', '(In #%s) %s'%(self.tkt.id, comment)))
+                    commented.add(n)
+                
+                old_value = old_values.get(n) or ''
+                delta = tickets[n] and ('', tkt_id) or (tkt_id, '')
+                if old_value == HUB_FIELD_VALUE:
+                    # The links of hub tickets are only kept in mastertickets
+                    changes.append((n, when_ts, author, field) + delta)
+                    continue
                 
-                if update_field is not None:
-                    cursor.execute('SELECT value FROM ticket_custom WHERE ticket=%s AND name=%s',
-                                   (n, str(field)))
-                    old_value = (cursor.fetchone() or ('',))[0]
-                    new_value = [x.strip() for x in old_value.split(',') if x.strip()]
-                    update_field(new_value)
+                new_value = [x.strip() for x in old_value.split(',') if x.strip()]
+                if tickets[n]:
+                    new_value.append(tkt_id)
+                elif tkt_id in new_value:
+                    new_value.remove(tkt_id)
+                
+                if hub_threshold and len(new_value) > hub_threshold:
+                    new_value = HUB_FIELD_VALUE
+                    changes.append((n, when_ts, author, field) + delta)
+                else:
                     new_value = ', '.join(sorted(new_value, key=lambda x: int(x)))
-            
-                    cursor.execute('INSERT INTO ticket_change (ticket, time, author, field, oldvalue, newvalue) VALUES (%s, %s, %s, %s, %s, %s)', 
-                                   (n, when_ts, author, field, old_value, new_value))
-                                   
-                    if comment:
-                        cursor.execute('INSERT INTO ticket_change (ticket, time, author, field, oldvalue, newvalue) VALUES (%s, %s, %s, %s, %s, %s)', 
-                                       (n, when_ts, author, 'comment', '', '(In #%s) %s'%(self.tkt.id, comment)))
-                                   
-                           
-                    cursor.execute('UPDATE ticket_custom SET value=%s WHERE ticket=%s AND name=%s',
-                                   (new_value, n, field))
-                    if not cursor.rowcount:
-                        cursor.execute('INSERT INTO ticket_custom (ticket, name, value) VALUES (%s, %s, %s)',
-                                       (n, field, new_value))
-        
-        # cursor.execute('DELETE FROM mastertickets WHERE source=%s OR dest=%s', (self.tkt.id, self.tkt.id))
-        # data = []
-        # for tkt in self.blocking:
-        #     if isinstance(tkt, Ticket):
-        #         tkt = tkt.id
-        #     data.append((self.tkt.id, tkt))
-        # for tkt in self.blocked_by:
-        #     if isisntance(tkt, Ticket):
-        #         tkt = tkt.id
-        #     data.append((tkt, self.tkt.id))
-        # 
-        # cursor.executemany('INSERT INTO mastertickets (source, dest) VALUES (%s, %s)', data)
+                    changes.append((n, when_ts, author, field, old_value, new_value))
+                
+                if n in old_values:
+                    custom_updates.append((new_value, n, field))
+                else:
+                    custom_inserts.append((n, field, new_value))
+        
+        if changes:
+            cursor.executemany('INSERT INTO ticket_change (ticket, time, author, field, oldvalue, newvalue) VALUES (%s, %s, %s, %s, %s, %s)',
+                               changes)
+        if custom_updates:
+            cursor.executemany('UPDATE ticket_custom SET value=%s WHERE ticket=%s AND name=%s', custom_updates)
+        if custom_inserts:
+            cursor.executemany('INSERT INTO ticket_custom (ticket, name, value) VALUES (%s, %s, %s)', custom_inserts)
         
         if handle_commit:
             db.commit()
@@ -128,21 +225,697 @@ class TicketLinks(object):
         return '<mastertickets.model.TicketLinks #%s blocking=%s blocked_by=%s>'% \
                (self.tkt.id, l(getattr(self, 'blocking', [])), l(getattr(self, 'blocked_by', [])))
 
-    def walk(self):
-        """Return an iterable of all links reachable directly above or below this one."""
-        def visit(tkt, memo, next_fn):
-            if tkt in memo:
-                return False
-            
-            links = TicketLinks(self.env, tkt)
-            memo[tkt] = links
-            
-            for n in next_fn(links):
-                visit(n, memo, next_fn)
-        
-        memo1 = {}
-        memo2 = {}
-        visit(str(self.tkt.id), memo1, lambda links: links.blocking)
-        visit(str(self.tkt.id), memo2, lambda links: links.blocked_by)
-        memo1.update(memo2)
-        return memo1.itervalues()
+    def walk(self, max_depth=None, max_nodes=None, db=None):
+        """Return an iterable of all links reachable directly above or below this one.
+        
+        See `walk_links` for the meaning of the arguments.
+        """
+        return walk_links(self.env, [self.tkt.id], max_depth, max_nodes, db)
+
+
+class LinkRecord(object):
+    """The links of a single ticket, as reached by `walk_links`.
+    
+    The ticket itself is only loaded when `tkt` is first accessed.
+    """
+    
+    __slots__ = ('env', 'id', 'depth', 'blocking', 'blocked_by', '_tkt')
+    
+    def __init__(self, env, id, depth):
+        self.env = env
+        self.id = id
+        self.depth = depth
+        self.blocking = set()
+        self.blocked_by = set()
+        self._tkt = None
+    
+    def tkt(self):
+        if self._tkt is None:
+            self._tkt = Ticket(self.env, self.id)
+            count('tickets')
+        return self._tkt
+    tkt = property(tkt)
+    
+    def __repr__(self):
+        return '<mastertickets.model.LinkRecord #%s blocking=%s blocked_by=%s>'% \
+               (self.id, sorted(self.blocking), sorted(self.blocked_by))
+
+
+IN_CHUNK_SIZE = 500
+
+def chunks(seq, size=IN_CHUNK_SIZE):
+    """Split `seq` into lists of at most `size` items, for use in `IN` clauses."""
+    seq = list(seq)
+    for i in xrange(0, len(seq), size):
+        yield seq[i:i+size]
+
+def select_links(cursor, column, ids):
+    """Yield `(source, dest)` for every link whose `column` is one of `ids`."""
+    for chunk in chunks(ids):
+        cursor.execute('SELECT source, dest FROM mastertickets WHERE %s IN (%s)' %
+                       (column, ','.join(['%s'] * len(chunk))), chunk)
+        for source, dest in cursor.fetchall():
+            yield int(source), int(dest)
+
+def closure_current(db):
+    """Return whether `mastertickets_closure` matches the current links.
+    
+    It does not until it has been rebuilt once, and no longer does after
+    links were changed without updating it.
+    """
+    cursor = db.cursor()
+    cursor.execute('SELECT value FROM system WHERE name=%s', (CLOSURE_GENERATION_NAME,))
+    row = cursor.fetchone()
+    return row is not None and int(row[0]) == get_generation(db)
+
+def update_closure(db, sources, generation):
+    """Bring `mastertickets_closure` up to date after the links leaving
+    `sources` changed, which bumped the link generation to `generation`.
+    
+    Only the rows of `sources` and their ancestors can be affected; those
+    are recomputed from the current links, reusing the stored rows of
+    every other ticket. A closure that was already out of date is left
+    alone until it is rebuilt.
+    """
+    cursor = db.cursor()
+    cursor.execute('SELECT value FROM system WHERE name=%s', (CLOSURE_GENERATION_NAME,))
+    row = cursor.fetchone()
+    if row is None or int(row[0]) != generation - 1:
+        return
+    affected = set([int(n) for n in sources])
+    for chunk in chunks(affected):
+        cursor.execute('SELECT ancestor FROM mastertickets_closure WHERE descendant IN (%s)' %
+                       ','.join(['%s'] * len(chunk)), chunk)
+        affected.update([int(n) for n, in cursor.fetchall()])
+    _recompute_closure(cursor, affected)
+    _set_generation(db, CLOSURE_GENERATION_NAME, generation)
+
+def rebuild_closure(db):
+    """Recompute the whole `mastertickets_closure` table and return the
+    number of rows written."""
+    cursor = db.cursor()
+    cursor.execute('DELETE FROM mastertickets_closure')
+    cursor.execute('SELECT DISTINCT source FROM mastertickets')
+    rows = _recompute_closure(cursor, set([int(n) for n, in cursor.fetchall()]))
+    _set_generation(db, CLOSURE_GENERATION_NAME, get_generation(db))
+    return rows
+
+def _recompute_closure(cursor, affected):
+    children = {}
+    for source, dest in select_links(cursor, 'source', affected):
+        children.setdefault(source, set()).add(dest)
+    
+    # Descendants of tickets outside the affected set are unchanged, and
+    # cannot lead back into it
+    descendants = {} # {ticket: {descendant: depth}}
+    outside = set()
+    for dests in children.itervalues():
+        outside |= dests - affected
+    for chunk in chunks(outside):
+        cursor.execute('SELECT ancestor, descendant, depth FROM mastertickets_closure '
+                       'WHERE ancestor IN (%s)' % ','.join(['%s'] * len(chunk)), chunk)
+        for ancestor, descendant, depth in cursor.fetchall():
+            descendants.setdefault(int(ancestor), {})[int(descendant)] = depth
+    
+    def merge(depths, n, depth):
+        for d, dd in [(n, 0)] + descendants.get(n, {}).items():
+            if d not in depths or depth + dd < depths[d]:
+                depths[d] = depth + dd
+    
+    # Visit the affected tickets children first, so each one is the union
+    # of its children's closures
+    pending = dict([(n, len(children.get(n, set()) & affected)) for n in affected])
+    parents = {}
+    for n in affected:
+        for c in children.get(n, ()):
+            if c in affected:
+                parents.setdefault(c, []).append(n)
+    ready = [n for n, count in pending.iteritems() if not count]
+    while ready:
+        n = ready.pop()
+        del pending[n]
+        depths = {}
+        for c in children.get(n, ()):
+            merge(depths, c, 1)
+        descendants[n] = depths
+        for p in parents.get(n, ()):
+            pending[p] -= 1
+            if not pending[p]:
+                ready.append(p)
+    
+    # Anything left is part of a cycle, so fall back to a plain search
+    for n in pending:
+        depths = {}
+        frontier = [n]
+        depth = 0
+        seen = set([n])
+        while frontier:
+            depth += 1
+            next_frontier = []
+            for m in frontier:
+                for c in children.get(m, ()):
+                    if c in affected:
+                        if c not in depths or depth < depths[c]:
+                            depths[c] = depth
+                        if c not in seen:
+                            seen.add(c)
+                            next_frontier.append(c)
+                    else:
+                        merge(depths, c, depth)
+            frontier = next_frontier
+        depths.pop(n, None)
+        descendants[n] = depths
+    
+    for chunk in chunks(affected):
+        cursor.execute('DELETE FROM mastertickets_closure WHERE ancestor IN (%s)' %
+                       ','.join(['%s'] * len(chunk)), chunk)
+    rows = []
+    for n in affected:
+        rows.extend([(n, d, depth) for d, depth in descendants[n].iteritems()])
+    if rows:
+        cursor.executemany('INSERT INTO mastertickets_closure (ancestor, descendant, depth) '
+                           'VALUES (%s, %s, %s)', rows)
+    return len(rows)
+
+def closure_reachable(env, ids, direction='blocking', max_depth=None, db=None):
+    """Return `{id: depth}` for the tickets reachable from `ids` according
+    to `mastertickets_closure`, `ids` themselves excluded.
+    
+    `direction` is either `'blocking'` (descendants) or `'blocked_by'`
+    (ancestors).
+    """
+    db = db or env.get_read_db()
+    cursor = db.cursor()
+    if direction == 'blocking':
+        columns = ('descendant', 'ancestor')
+    elif direction == 'blocked_by':
+        columns = ('ancestor', 'descendant')
+    else:
+        raise ValueError('Unknown direction %r' % direction)
+    ids = set([int(n) for n in ids])
+    depth_clause = ''
+    args = []
+    if max_depth is not None:
+        depth_clause = ' AND depth<=%s'
+        args = [max_depth]
+    reachable = {}
+    for chunk in chunks(ids):
+        cursor.execute('SELECT %s, depth FROM mastertickets_closure WHERE %s IN (%s)%s' %
+                       (columns[0], columns[1], ','.join(['%s'] * len(chunk)), depth_clause),
+                       chunk + args)
+        for n, depth in cursor.fetchall():
+            n = int(n)
+            if n not in ids and (n not in reachable or depth < reachable[n]):
+                reachable[n] = depth
+    count('walk_nodes', len(reachable))
+    return reachable
+
+def links_within(env, tkt_id, max_depth, closure=False, db=None):
+    """Return `{id: blocking}` for the tickets at most `max_depth` links
+    above or below `tkt_id`, including only links among them.
+    
+    With `closure`, the tickets are looked up in `mastertickets_closure`
+    instead of walking the links, as long as it is up to date.
+    """
+    db = db or env.get_read_db()
+    tkt_id = int(tkt_id)
+    if closure and closure_current(db):
+        ids = set([tkt_id])
+        ids.update(closure_reachable(env, [tkt_id], 'blocking', max_depth, db))
+        ids.update(closure_reachable(env, [tkt_id], 'blocked_by', max_depth, db))
+    else:
+        ids = set([record.id for record in walk_links(env, [tkt_id], max_depth, db=db)])
+    links = dict([(n, set()) for n in ids])
+    for source, dest in select_links(db.cursor(), 'source', ids):
+        if dest in ids:
+            links[source].add(dest)
+    return links
+
+def update_blocker_counts(db, ids):
+    """Recompute the number of open blockers of the tickets in `ids`.
+    
+    `mastertickets_blockers` only has rows for tickets with at least one
+    blocker that is not closed.
+    """
+    cursor = db.cursor()
+    for chunk in chunks(set([int(n) for n in ids])):
+        holders = ','.join(['%s'] * len(chunk))
+        cursor.execute('DELETE FROM mastertickets_blockers WHERE ticket IN (%s)' % holders,
+                       chunk)
+        cursor.execute("INSERT INTO mastertickets_blockers (ticket, open_blockers) "
+                       "SELECT m.dest, COUNT(*) FROM mastertickets m "
+                       "JOIN ticket t ON t.id=m.source "
+                       "WHERE m.dest IN (%s) AND t.status<>'closed' "
+                       "GROUP BY m.dest" % holders, chunk)
+
+def rebuild_blocker_counts(db):
+    """Recompute the whole `mastertickets_blockers` table."""
+    cursor = db.cursor()
+    cursor.execute('DELETE FROM mastertickets_blockers')
+    cursor.execute("INSERT INTO mastertickets_blockers (ticket, open_blockers) "
+                   "SELECT m.dest, COUNT(*) FROM mastertickets m "
+                   "JOIN ticket t ON t.id=m.source "
+                   "WHERE t.status<>'closed' GROUP BY m.dest")
+
+def link_field_values(db, ids, hub_threshold=0):
+    """Return `{id: (blocking, blockedby)}` for the tickets in `ids`, with
+    the values the custom fields should have according to `mastertickets`."""
+    cursor = db.cursor()
+    ids = set([int(n) for n in ids])
+    links = dict([(n, ([], [])) for n in ids])
+    for source, dest in select_links(cursor, 'source', ids):
+        links[source][0].append(dest)
+    for source, dest in select_links(cursor, 'dest', ids):
+        links[dest][1].append(source)
+    return _join_link_fields(links, hub_threshold)
+
+def link_fields_in_range(db, first, last, hub_threshold=0):
+    """Return `{id: (blocking, blockedby)}` like `link_field_values`, for
+    every ticket with an id between `first` and `last` inclusive.
+
+    Links are read with one range scan per direction instead of `IN` lists.
+    """
+    cursor = db.cursor()
+    cursor.execute('SELECT id FROM ticket WHERE id>=%s AND id<=%s', (first, last))
+    links = dict([(int(n), ([], [])) for n, in cursor.fetchall()])
+    cursor.execute('SELECT source, dest FROM mastertickets WHERE source>=%s AND source<=%s',
+                   (first, last))
+    for source, dest in cursor.fetchall():
+        if int(source) in links:
+            links[int(source)][0].append(int(dest))
+    cursor.execute('SELECT source, dest FROM mastertickets WHERE dest>=%s AND dest<=%s',
+                   (first, last))
+    for source, dest in cursor.fetchall():
+        if int(dest) in links:
+            links[int(dest)][1].append(int(source))
+    return _join_link_fields(links, hub_threshold)
+
+def _join_link_fields(links, hub_threshold=0):
+    def join(ids):
+        if hub_threshold and len(ids) > hub_threshold:
+            return HUB_FIELD_VALUE
+        return ', '.join([str(x) for x in sorted(ids)])
+    values = {}
+    for n, (blocking, blocked_by) in links.iteritems():
+        values[n] = (join(blocking), join(blocked_by))
+    return values
+
+def rebuild_link_fields(db, ids, hub_threshold=0):
+    """Rewrite the `blocking` and `blockedby` custom fields of the tickets
+    in `ids` from the `mastertickets` table.
+
+    Fields with more than `hub_threshold` ids are set to `HUB_FIELD_VALUE`.
+    Unlike `TicketLinks.save` this records no ticket changes.
+    """
+    cursor = db.cursor()
+    for chunk in chunks(set([int(n) for n in ids])):
+        values = link_field_values(db, chunk, hub_threshold)
+        cursor.execute("DELETE FROM ticket_custom WHERE name IN ('blocking', 'blockedby') "
+                       "AND ticket IN (%s)" % ','.join(['%s'] * len(chunk)), chunk)
+        rows = []
+        for n in sorted(values):
+            blocking, blocked_by = values[n]
+            rows.append((n, 'blocking', blocking))
+            rows.append((n, 'blockedby', blocked_by))
+        cursor.executemany('INSERT INTO ticket_custom (ticket, name, value) VALUES (%s, %s, %s)',
+                           rows)
+
+# The column holding the ticket, and the one holding its links, for each field
+LINK_COLUMNS = {'blocking': ('source', 'dest'), 'blockedby': ('dest', 'source')}
+
+def link_status_counts(env, tkt_id, field, db=None):
+    """Return `(open, closed)`, the number of open and closed tickets in the
+    `blocking` or `blockedby` links of `tkt_id`."""
+    column, other = LINK_COLUMNS[field]
+    db = db or env.get_read_db()
+    cursor = db.cursor()
+    cursor.execute("SELECT COUNT(*), SUM(CASE WHEN t.status='closed' THEN 1 ELSE 0 END) "
+                   "FROM mastertickets m JOIN ticket t ON t.id=m.%s "
+                   "WHERE m.%s=%%s" % (other, column), (int(tkt_id),))
+    total, closed = cursor.fetchone()
+    closed = int(closed or 0)
+    return int(total) - closed, closed
+
+def link_page(env, tkt_id, field, offset, limit, db=None):
+    """Return `(total, ids)` with the number of `blocking` or `blockedby`
+    links of `tkt_id`, and the ids of `limit` of them from `offset` on, in
+    ticket order."""
+    column, other = LINK_COLUMNS[field]
+    db = db or env.get_read_db()
+    cursor = db.cursor()
+    cursor.execute('SELECT COUNT(*) FROM mastertickets WHERE %s=%%s' % column,
+                   (int(tkt_id),))
+    total = int(cursor.fetchone()[0])
+    cursor.execute('SELECT %s FROM mastertickets WHERE %s=%%s ORDER BY %s '
+                   'LIMIT %d OFFSET %d' % (other, column, other, limit, offset),
+                   (int(tkt_id),))
+    return total, [int(n) for n, in cursor.fetchall()]
+
+def open_blocker_counts(env, ids, db=None):
+    """Return `{id: count}` for the tickets in `ids` that have open blockers."""
+    ids = set([int(n) for n in ids])
+    counts = {}
+    cache = request_cache.current()
+    if cache is not None:
+        for n in list(ids):
+            if n in cache['open_blockers']:
+                ids.discard(n)
+                if cache['open_blockers'][n] is not None:
+                    counts[n] = cache['open_blockers'][n]
+    if not ids:
+        return counts
+    
+    db = db or env.get_read_db()
+    cursor = db.cursor()
+    for chunk in chunks(ids):
+        cursor.execute('SELECT ticket, open_blockers FROM mastertickets_blockers '
+                       'WHERE ticket IN (%s)' % ','.join(['%s'] * len(chunk)), chunk)
+        for ticket, count in cursor.fetchall():
+            counts[int(ticket)] = count
+    if cache is not None:
+        for n in ids:
+            cache['open_blockers'][n] = counts.get(n)
+    return counts
+
+def ready_tickets(env, fields, filters=None, limit=None, offset=0, db=None):
+    """Yield `(id, value, ...)` with the requested `fields` of every open
+    ticket without open blockers, in ticket order.
+    
+    `filters` is as for `linked_tickets`.
+    """
+    db = db or env.get_read_db()
+    cursor = db.cursor()
+    for field in fields:
+        if field not in TICKET_COLUMNS:
+            raise ValueError('Unknown ticket field %r' % field)
+    where, args = _filter_clause('t', filters)
+    sql = ("SELECT t.id%s FROM ticket t "
+           "LEFT OUTER JOIN mastertickets_blockers b ON b.ticket=t.id "
+           "WHERE t.status<>'closed' AND b.ticket IS NULL AND %s "
+           "ORDER BY t.id" % (''.join([', t.' + f for f in fields]), where))
+    if limit is not None:
+        sql += ' LIMIT %d OFFSET %d' % (limit, offset)
+    cursor.execute(sql, args)
+    for row in cursor:
+        yield tuple([int(row[0])] + [value is None and '' or value for value in row[1:]])
+
+def database_scheme(env):
+    """Return the scheme of the configured database, e.g. `'sqlite'`."""
+    return env.config.get('trac', 'database').split(':', 1)[0]
+
+def find_cycle(env, tkt_id, blocking, blocked_by, db=None, closure=False):
+    """Look for a dependency cycle that saving these links would create.
+    
+    `blocking` and `blocked_by` are the proposed links of ticket `tkt_id`
+    (which is `None` for a new ticket). Returns the path of ticket ids from
+    a member of `blocking` down to a member of `blocked_by`, or `None` if
+    there is no such path.
+    
+    On SQLite and PostgreSQL the common case of no cycle is answered by a
+    single `WITH RECURSIVE` query, and a path by one more that returns all
+    links below `blocking`. Other backends use a breadth first search with
+    one query per level. With `closure`, the no-cycle case is instead
+    looked up in `mastertickets_closure`, unless it is out of date.
+    """
+    blocking = set([int(n) for n in blocking])
+    blocked_by = set([int(n) for n in blocked_by])
+    if not blocking or not blocked_by:
+        return None
+    
+    db = db or env.get_read_db()
+    cursor = db.cursor()
+    recursive = database_scheme(env) in ('sqlite', 'postgres') and \
+                len(blocking) + len(blocked_by) <= IN_CHUNK_SIZE
+    reach = exclude = ''
+    reach_args = list(blocking)
+    if recursive:
+        if tkt_id is not None:
+            # The stored links of the ticket itself are about to be replaced
+            exclude = ' AND m.source<>%s AND m.dest<>%s'
+            reach_args += [tkt_id, tkt_id]
+        reach = """
+            WITH RECURSIVE reach(id) AS (
+                SELECT id FROM ticket WHERE id IN (%s)
+              UNION
+                SELECT m.dest FROM mastertickets m, reach r
+                WHERE m.source=r.id%s
+            )""" % (','.join(['%s'] * len(blocking)), exclude)
+    
+    if closure and closure_current(db):
+        # The closure may include paths through the ticket's own stored
+        # links, so a hit still has to be confirmed below
+        found = bool(blocking & blocked_by)
+        for ancestors in chunks(blocking):
+            for descendants in chunks(blocked_by):
+                if found:
+                    break
+                cursor.execute('SELECT 1 FROM mastertickets_closure WHERE ancestor IN (%s) '
+                               'AND descendant IN (%s)' % (','.join(['%s'] * len(ancestors)),
+                                                           ','.join(['%s'] * len(descendants))),
+                               ancestors + descendants)
+                found = cursor.fetchone() is not None
+        if not found:
+            return None
+    elif recursive:
+        cursor.execute(reach + """
+            SELECT id FROM reach WHERE id IN (%s) LIMIT 1
+            """ % ','.join(['%s'] * len(blocked_by)), reach_args + list(blocked_by))
+        if cursor.fetchone() is None:
+            return None
+    
+    if recursive:
+        children = {}
+        cursor.execute(reach + """
+            SELECT m.source, m.dest FROM mastertickets m, reach r
+            WHERE m.source=r.id%s
+            """ % exclude, reach_args + reach_args[len(blocking):])
+        for source, dest in cursor.fetchall():
+            children.setdefault(int(source), []).append(int(dest))
+        def links(frontier):
+            for n in sorted(frontier):
+                for dest in sorted(children.get(n, ())):
+                    yield n, dest
+    else:
+        def links(frontier):
+            return select_links(cursor, 'source', frontier)
+    return _find_path(links, tkt_id, blocking, blocked_by)
+
+def _find_path(links, tkt_id, blocking, blocked_by):
+    parents = dict([(n, None) for n in blocking])
+    frontier = blocking
+    while frontier:
+        for n in sorted(frontier):
+            if n in blocked_by:
+                path = [n]
+                while parents[path[-1]] is not None:
+                    path.append(parents[path[-1]])
+                path.reverse()
+                return path
+        next_frontier = set()
+        for source, dest in links(frontier):
+            if tkt_id is not None and tkt_id in (source, dest):
+                continue
+            if dest not in parents:
+                parents[dest] = source
+                next_frontier.add(dest)
+        frontier = next_frontier
+    return None
+
+TICKET_COLUMNS = ('type', 'time', 'changetime', 'component', 'severity',
+                  'priority', 'owner', 'reporter', 'cc', 'version', 'milestone',
+                  'status', 'resolution', 'summary', 'description', 'keywords')
+
+def load_ticket_attrs(env, ids, fields, db=None):
+    """Return `{id: {field: value}}` for the tickets in `ids`.
+    
+    This reads just the requested fields of many tickets with a few chunked
+    queries, joining `ticket_custom` for custom fields, instead of loading a
+    full `Ticket` for each id. Tickets that do not exist are left out.
+    """
+    db = db or env.get_read_db()
+    cursor = db.cursor()
+    
+    fields = list(fields)
+    custom = set([f['name'] for f in TicketSystem(env).get_custom_fields()])
+    columns = []
+    joins = []
+    join_args = []
+    for i, field in enumerate(fields):
+        if field in TICKET_COLUMNS:
+            columns.append('t.%s' % field)
+        elif field in custom:
+            columns.append('c%d.value' % i)
+            joins.append('LEFT OUTER JOIN ticket_custom c%d ON '
+                         '(c%d.ticket=t.id AND c%d.name=%%s)' % (i, i, i))
+            join_args.append(field)
+        else:
+            raise ValueError('Unknown ticket field %r' % field)
+    
+    ids = set([int(n) for n in ids])
+    attrs = {}
+    cache = request_cache.current()
+    if cache is not None:
+        # Answer from the request cache where every field is already known
+        for n in list(ids):
+            if n not in cache['attrs']:
+                continue
+            known = cache['attrs'][n]
+            if known is None:
+                ids.discard(n)
+            elif not [f for f in fields if f not in known]:
+                ids.discard(n)
+                attrs[n] = dict([(f, known[f]) for f in fields])
+    
+    loaded = 0
+    for chunk in chunks(ids):
+        cursor.execute('SELECT t.id%s FROM ticket t %s WHERE t.id IN (%s)' %
+                       (''.join([', ' + c for c in columns]), ' '.join(joins),
+                        ','.join(['%s'] * len(chunk))), join_args + chunk)
+        for row in cursor.fetchall():
+            values = {}
+            for field, value in zip(fields, row[1:]):
+                if value is None:
+                    value = ''
+                values[field] = value
+            attrs[int(row[0])] = values
+            loaded += 1
+    if cache is not None:
+        for n in ids:
+            if n in attrs:
+                cache['attrs'].setdefault(n, {}).update(attrs[n])
+            else:
+                cache['attrs'][n] = None
+    count('tickets', loaded)
+    return attrs
+
+def _filter_clause(alias, filters):
+    """Build a `WHERE` fragment matching `filters`, a `{field: [value, ...]}`
+    dictionary of lowercase values, against the ticket table `alias`."""
+    clauses = []
+    args = []
+    for field, values in sorted((filters or {}).items()):
+        if field not in TICKET_COLUMNS:
+            raise ValueError('Unknown ticket field %r' % field)
+        clauses.append('LOWER(%s.%s) IN (%s)' % (alias, field, ','.join(['%s'] * len(values))))
+        args.extend(values)
+    return ' AND '.join(clauses) or '1=1', args
+
+def linked_tickets(env, fields, filters=None, db=None):
+    """Yield `(id, value, ...)` with the requested `fields` of every ticket
+    that has at least one link and matches `filters`.
+    
+    `filters` maps ticket fields to lists of accepted lowercase values.
+    """
+    db = db or env.get_read_db()
+    cursor = db.cursor()
+    for field in fields:
+        if field not in TICKET_COLUMNS:
+            raise ValueError('Unknown ticket field %r' % field)
+    where, args = _filter_clause('t', filters)
+    cursor.execute('SELECT t.id%s FROM ticket t WHERE %s AND '
+                   '(t.id IN (SELECT source FROM mastertickets) OR '
+                   't.id IN (SELECT dest FROM mastertickets))' %
+                   (''.join([', t.' + f for f in fields]), where), args)
+    for row in cursor:
+        yield tuple([int(row[0])] + [value is None and '' or value for value in row[1:]])
+
+def filtered_links(env, filters=None, db=None):
+    """Yield `(source, dest)` for every link where both tickets match
+    `filters`, as for `linked_tickets`."""
+    db = db or env.get_read_db()
+    cursor = db.cursor()
+    source_where, source_args = _filter_clause('s', filters)
+    dest_where, dest_args = _filter_clause('d', filters)
+    cursor.execute('SELECT m.source, m.dest FROM mastertickets m '
+                   'JOIN ticket s ON s.id=m.source JOIN ticket d ON d.id=m.dest '
+                   'WHERE %s AND %s' % (source_where, dest_where),
+                   source_args + dest_args)
+    for source, dest in cursor:
+        yield int(source), int(dest)
+
+def last_changed(env, ids, db=None):
+    """Return the time of the latest change to any of the tickets in `ids`,
+    as a microsecond timestamp, or 0 if there is none.
+    
+    This covers the tickets' own `changetime` as well as link changes made
+    from the other end, which `TicketLinks.save` records in `ticket_change`.
+    """
+    db = db or env.get_read_db()
+    cursor = db.cursor()
+    latest = 0
+    for chunk in chunks(set([int(n) for n in ids])):
+        holders = ','.join(['%s'] * len(chunk))
+        cursor.execute('SELECT MAX(changetime) FROM ticket WHERE id IN (%s)' % holders,
+                       chunk)
+        latest = max(latest, cursor.fetchone()[0] or 0)
+        cursor.execute("SELECT MAX(time) FROM ticket_change WHERE ticket IN (%s) "
+                       "AND field IN ('blocking', 'blockedby')" % holders, chunk)
+        latest = max(latest, cursor.fetchone()[0] or 0)
+    return latest
+
+def walk_links(env, ids, max_depth=None, max_nodes=None, db=None, direction='both',
+               truncated=None):
+    """Walk the tickets reachable directly above or below `ids`.
+    
+    Tickets are visited breadth first, fetching the links of a whole level
+    with one query per direction. A `LinkRecord` is yielded for each ticket.
+    The walk stops after `max_depth` levels or `max_nodes` records if those
+    are given. `direction` can be `'blocking'` or `'blocked_by'` to only
+    walk below or above `ids`.
+    
+    If `truncated` is a list, `True` is appended to it when one of the
+    limits left out tickets that would have been walked otherwise. This is
+    known from the links already fetched, without querying further.
+    """
+    if direction not in ('both', 'blocking', 'blocked_by'):
+        raise ValueError('Unknown direction %r' % direction)
+    db = db or env.get_read_db()
+    cursor = db.cursor()
+    
+    records = {}
+    down = set(int(n) for n in ids)
+    up = set(down)
+    if direction == 'blocking':
+        up = set()
+    elif direction == 'blocked_by':
+        down = set()
+    seen_down = set(down)
+    seen_up = set(up)
+    depth = 0
+    while down or up:
+        level = {}
+        for n in down | up:
+            if n not in records:
+                level[n] = LinkRecord(env, n, depth)
+        for source, dest in select_links(cursor, 'source', level.keys()):
+            level[source].blocking.add(dest)
+        for source, dest in select_links(cursor, 'dest', level.keys()):
+            level[dest].blocked_by.add(source)
+        count('walk_nodes', len(level))
+        
+        for n in sorted(level):
+            if max_nodes is not None and len(records) >= max_nodes:
+                if truncated is not None:
+                    truncated.append(True)
+                return
+            records[n] = level[n]
+            yield level[n]
+        
+        next_down = set()
+        for n in down:
+            next_down |= records[n].blocking
+        down = next_down - seen_down
+        seen_down |= down
+        
+        next_up = set()
+        for n in up:
+            next_up |= records[n].blocked_by
+        up = next_up - seen_up
+        seen_up |= up
+        
+        if (max_depth is not None and depth >= max_depth) or \
+                (max_nodes is not None and len(records) >= max_nodes):
+            if truncated is not None and (down | up) - set(records):
+                truncated.append(True)
+            return
+        depth += 1
@@ -0,0 +1,142 @@
+import threading
+import time
+
+from trac.core import *
+from trac.config import IntOption
+from trac.web.href import Href
+
+from index import DependencyIndex
+from render import RenderError
+from stats import MasterTicketsStats
+
+
+class _Context(object):
+    """Stands in for the request and wiki formatter of an interactive view,
+    which is all the graph builders look at."""
+
+    def __init__(self, base_url, href):
+        self.base_url = base_url
+        self.href = href
+        self.path_info = ''
+        self.req = self
+
+
+class GraphPrerenderer(Component):
+    """Renders dependency graphs in the background after ticket changes.
+
+    `MasterTicketsSystem` schedules the tickets whose links or graph fields
+    changed, along with their neighbours. After `prerender_delay` seconds
+    without further changes to a ticket, a worker thread renders its
+    `/depgraph` page into the render cache and re-expands the `DepGraph`
+    macros that were recently shown, so the next view finds them ready.
+    """
+
+    delay = IntOption('mastertickets', 'prerender_delay', default=5,
+        doc='Number of seconds to wait after the last change to a ticket '
+            'before its dependency graph is rendered in the background.')
+    queue_size = IntOption('mastertickets', 'prerender_queue_size', default=200,
+        doc='Maximum number of tickets waiting to have their dependency graph '
+            'rendered in the background. Further changes are not pre-rendered.')
+    workers = IntOption('mastertickets', 'prerender_workers', default=1,
+        doc='Number of background threads rendering dependency graphs after '
+            'ticket changes. Set to 0 to disable pre-rendering.')
+
+    MACROS = 'macros'
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._pending = {} # {ticket id or MACROS: time due}
+        self._threads = []
+        self._base_url = None
+        self._href_base = None
+
+    # Public methods
+    def schedule(self, ids):
+        """Queue the `/depgraph` pages of the tickets in `ids`, and the
+        recently shown macros, to be rendered once the changes settle."""
+        if self.workers <= 0:
+            return
+        due = time.time() + self.delay
+        self._cond.acquire()
+        try:
+            for key in [int(n) for n in ids] + [self.MACROS]:
+                if key not in self._pending and len(self._pending) >= self.queue_size:
+                    self.log.debug('MasterTickets: Pre-render queue full, dropping %s', key)
+                    continue
+                self._pending[key] = due
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work,
+                                          name='mastertickets-prerender')
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def remember(self, req):
+        """Note the URLs of an interactive `/depgraph` view, so pre-rendered
+        graphs link to the same place."""
+        self._base_url = req.base_url
+        self._href_base = req.href.base
+
+    # Internal methods
+    def _work(self):
+        stats = MasterTicketsStats(self.env)
+        while True:
+            key = self._next()
+            # Counted apart from the interactive entry points
+            scope = stats.start('prerender')
+            try:
+                try:
+                    if key == self.MACROS:
+                        self._render_macros()
+                    else:
+                        self._render_ticket(key)
+                except Exception, e:
+                    self.log.warning('MasterTickets: Pre-rendering %s failed: %s', key, e)
+            finally:
+                stats.finish(scope)
+
+    def _next(self):
+        """Wait for the next due key, and remove it from the queue."""
+        self._cond.acquire()
+        try:
+            while True:
+                now = time.time()
+                if self._pending:
+                    key, due = min(self._pending.iteritems(), key=lambda item: item[1])
+                    if due <= now:
+                        del self._pending[key]
+                        return key
+                    self._cond.wait(due - now)
+                else:
+                    self._cond.wait()
+        finally:
+            self._cond.release()
+
+    def _render_ticket(self, tkt_id):
+        from web_ui import MasterTicketsModule
+        if self._href_base is not None:
+            href = Href(self._href_base)
+        else:
+            href = self.env.href
+        module = MasterTicketsModule(self.env)
+        links = DependencyIndex(self.env).walk(tkt_id)
+        if len(links) <= 1:
+            return # No depgraph page to show
+        start = time.time()
+        try:
+            module.cache_graph(module._build_graph(_Context(self._base_url, href),
+                                                   tkt_id, links))
+        except RenderError, e:
+            self.log.debug('MasterTickets: Could not pre-render #%s: %s', tkt_id, e)
+            return
+        self.log.debug('MasterTickets: Pre-rendered #%s in %.3fs', tkt_id,
+                       time.time() - start)
+
+    def _render_macros(self):
+        from macro_provider import MasterTicketsMacros
+        macros = MasterTicketsMacros(self.env)
+        for content, args, base_url, href_base in macros.recent():
+            macros._expand_memoized(_Context(base_url, Href(href_base)), content, args)
@@ -0,0 +1,479 @@
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+from trac.core import *
+from trac.config import Option, BoolOption, IntOption
+
+from stats import count
+
+
+class RenderError(TracError):
+    """Raised when a graph could not be rendered."""
+
+
+class GraphTooLarge(RenderError):
+    """Raised for graphs larger than `render_max_size`."""
+
+
+class RendererBusy(RenderError):
+    """Raised when no render slot became free within `render_queue_timeout`."""
+
+
+class GraphRenderer(Component):
+    """Renders dependency graphs with Graphviz.
+
+    Output is cached on disk under the environment's `files` directory,
+    keyed by a hash of the DOT source, the output format and the renderer
+    options. The DOT source is streamed to dot, which writes straight to
+    the cache. Entries are written atomically so several processes can share
+    the cache, and the least recently used ones are evicted when the cache
+    grows beyond `render_cache_size` or an entry has not been used for
+    `render_cache_max_age` days.
+
+    At most `render_max_concurrent` renders run at once. Further requests
+    wait up to `render_queue_timeout` seconds for a slot and are then
+    turned away with `RendererBusy`, and renderer processes that run longer
+    than `render_timeout` seconds are killed.
+    """
+
+    dot_path = Option('mastertickets', 'dot_path', default='dot',
+                      doc='Path to the dot executable.')
+    gs_path = Option('mastertickets', 'gs_path', default='gs',
+                     doc='Path to the ghostscript executable.')
+    use_gs = BoolOption('mastertickets', 'use_gs', default=False,
+                        doc='If enabled, use ghostscript to produce nicer output.')
+    cache_size = IntOption('mastertickets', 'render_cache_size', default=50,
+                           doc='Maximum size of the rendered graph cache, in megabytes.')
+    cache_max_age = IntOption('mastertickets', 'render_cache_max_age', default=7,
+                              doc='Number of days a rendered graph is kept in the '
+                                  'cache after it was last used.')
+    max_concurrent = IntOption('mastertickets', 'render_max_concurrent', default=2,
+                               doc='Maximum number of graphs rendered at the same time.')
+    queue_timeout = IntOption('mastertickets', 'render_queue_timeout', default=5,
+                              doc='Number of seconds a request waits for a free '
+                                  'render slot before giving up.')
+    timeout = IntOption('mastertickets', 'render_timeout', default=30,
+                        doc='Number of seconds after which a dot or gs process is killed.')
+    max_size = IntOption('mastertickets', 'render_max_size', default=1024,
+                         doc='Largest graph that will be rendered, in kilobytes '
+                             'of DOT source. Set to 0 for no limit.')
+
+    KEY_RE = re.compile(r'^[0-9a-f]{40}$')
+    # Output formats as in dot's -T option, e.g. png, ps2 or svg:cairo
+    FORMAT_RE = re.compile(r'^[a-z0-9_]+(:[a-z0-9_]+)*$')
+    TEMP_PREFIX = '.tmp'
+    # Temporary files older than this were left behind by a crashed render
+    TEMP_MAX_AGE = 24 * 3600
+    EVICT_INTERVAL = 60
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._last_evict = 0
+        self._slots = threading.Condition(threading.Lock())
+        self._active = 0
+        self._waiting = 0
+        self._renders = 0
+        self._rejected = 0
+        self._timeouts = 0
+        self._wait_time = 0.0
+        self._render_time = 0.0
+
+    # Public methods
+    def render(self, graph, format='png'):
+        """Render `graph` to `format` and return the output.
+
+        `graph` is a `graphviz.Graph`, DOT source, or a function returning
+        an iterable of chunks of DOT source. PNG output goes through
+        ghostscript if `use_gs` is enabled.
+        """
+        return self.render_many(graph, [format])[format][1]
+
+    def cache(self, graph, format='png'):
+        """Make sure the rendering of `graph` is in the cache and return its
+        key, for later use with `get` or `open`."""
+        return self.cache_many(graph, [format])[format]
+
+    def render_many(self, graph, formats):
+        """Render `graph` to several formats like `cache_many`, and return
+        `{format: (key, data)}`."""
+        results = {}
+        for format, key in self.cache_many(graph, formats).iteritems():
+            data = self.get(key, format)
+            if data is None:
+                raise RenderError('The rendered graph was removed from the cache')
+            results[format] = (key, data)
+        return results
+
+    def cache_many(self, graph, formats):
+        """Make sure the renderings of `graph` to several formats are in the
+        cache, running dot only once for all of them that are not cached
+        yet, and return `{format: key}`.
+
+        The DOT source is never held in memory as a whole. It is generated
+        once to compute the keys and, if anything needs rendering, once more
+        to stream it to dot, whose output goes straight to the cache.
+        """
+        chunks = self._dot_chunks(graph)
+        keys, size = self._cache_keys(chunks(), formats)
+        missing = []
+        for format in formats:
+            key = keys[format]
+            hit = self.has(key, format)
+            self._count(hit, key)
+            if hit:
+                try:
+                    os.utime(self._cache_path(key, format), None)
+                except OSError:
+                    pass
+            else:
+                missing.append(format)
+        if not missing:
+            return keys
+
+        if self.max_size and size > self.max_size * 1024:
+            raise GraphTooLarge('The graph is too large to be rendered')
+        self._acquire_slot()
+        start = time.time()
+        try:
+            dot_formats = []
+            for format in missing:
+                if format == 'png' and self.use_gs:
+                    self._render_gs(chunks(), self._cache_path(keys[format], format))
+                else:
+                    dot_formats.append(format)
+            if dot_formats:
+                self._render_dot(chunks(), dot_formats,
+                                 [self._cache_path(keys[format], format)
+                                  for format in dot_formats])
+        finally:
+            self._release_slot(time.time() - start)
+        self._maybe_evict()
+        return keys
+
+    def metrics(self):
+        """Return a dictionary of counters describing the render queue."""
+        self._slots.acquire()
+        try:
+            return {
+                'active': self._active,
+                'waiting': self._waiting,
+                'renders': self._renders,
+                'rejected': self._rejected,
+                'timeouts': self._timeouts,
+                'avg_wait': self._renders and self._wait_time / self._renders or 0.0,
+                'avg_render': self._renders and self._render_time / self._renders or 0.0,
+            }
+        finally:
+            self._slots.release()
+
+    def get(self, key, format='png'):
+        """Return the cached rendering for `key`, or `None` if it is gone."""
+        f = self.open(key, format)
+        if f is None:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def open(self, key, format='png'):
+        """Return the cached rendering for `key` as an open file, or `None`
+        if it is gone. The file stays readable if it is evicted meanwhile."""
+        if not self.KEY_RE.match(key) or not self.FORMAT_RE.match(format):
+            return None
+        try:
+            return open(self._cache_path(key, format), 'rb')
+        except IOError:
+            return None
+
+    def has(self, key, format='png'):
+        """Return whether a rendering for `key` is still in the cache."""
+        return bool(self.KEY_RE.match(key) and self.FORMAT_RE.match(format)) and \
+               os.path.exists(self._cache_path(key, format))
+
+    # Internal methods
+    def _acquire_slot(self):
+        start = time.time()
+        deadline = start + self.queue_timeout
+        self._slots.acquire()
+        try:
+            self._waiting += 1
+            try:
+                while self._active >= max(self.max_concurrent, 1):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._rejected += 1
+                        self.log.info('MasterTickets: Renderer busy, %d renders '
+                                      'active and %d waiting', self._active,
+                                      self._waiting - 1)
+                        raise RendererBusy('The graph renderer is busy, please '
+                                           'try again later')
+                    self._slots.wait(remaining)
+            finally:
+                self._waiting -= 1
+            self._active += 1
+            self._wait_time += time.time() - start
+        finally:
+            self._slots.release()
+
+    def _release_slot(self, elapsed):
+        self._slots.acquire()
+        try:
+            self._active -= 1
+            self._renders += 1
+            self._render_time += elapsed
+            self._slots.notify()
+        finally:
+            self._slots.release()
+        self.log.debug('MasterTickets: Rendered graph in %.3fs (%s)', elapsed,
+                       self.metrics())
+
+    def _dot_chunks(self, graph):
+        """Return a function returning the DOT source of `graph` in chunks
+        of UTF-8."""
+        if isinstance(graph, unicode):
+            graph = graph.encode('utf8')
+        if isinstance(graph, str):
+            return lambda: [graph]
+        if hasattr(graph, 'iter_dot'):
+            return graph.iter_dot
+        return graph
+
+    def _cache_keys(self, chunks, formats):
+        """Return the cache key of each format, and the size of the DOT
+        source read from `chunks`."""
+        digests = {}
+        for format in formats:
+            options = [format, self.dot_path]
+            if format == 'png' and self.use_gs:
+                options.append(self.gs_path)
+            digests[format] = sha1('\0'.join(options + ['']))
+        size = 0
+        for chunk in chunks:
+            size += len(chunk)
+            for digest in digests.itervalues():
+                digest.update(chunk)
+        return dict([(format, digest.hexdigest())
+                     for format, digest in digests.iteritems()]), size
+
+    def _cache_dir(self):
+        return os.path.join(self.env.path, 'files', 'mastertickets', 'render')
+
+    def _cache_path(self, key, format):
+        # Both end up in a file name, so neither may contain a path
+        if not self.KEY_RE.match(key) or not self.FORMAT_RE.match(format):
+            raise ValueError('Invalid render cache entry %r.%r' % (key, format))
+        return os.path.join(self._cache_dir(), '%s.%s' % (key, format))
+
+    def _count(self, hit, key):
+        self._lock.acquire()
+        try:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+            hits, misses = self._hits, self._misses
+        finally:
+            self._lock.release()
+        self.log.debug('MasterTickets: Render cache %s for %s (%d hits, %d misses)',
+                       hit and 'hit' or 'miss', key, hits, misses)
+
+    def _render_gs(self, chunks, path):
+        fd, ps = tempfile.mkstemp(suffix='.ps')
+        os.close(fd)
+        try:
+            self._render_dot(chunks, ['ps2'], [ps], cache=False)
+            input = open(ps, 'rb')
+            try:
+                self._run_to([self.gs_path, '-q', '-dTextAlphaBits=4',
+                              '-dGraphicsAlphaBits=4', '-sDEVICE=png16m',
+                              '-sOutputFile=%stdout%', '-'], input, path)
+            finally:
+                input.close()
+        finally:
+            try:
+                os.unlink(ps)
+            except OSError:
+                pass
+
+    def _render_dot(self, chunks, formats, paths, cache=True):
+        """Let a single dot run write each of `formats` to the matching file
+        in `paths`, atomically if they are in the cache."""
+        args = [self.dot_path]
+        tmps = []
+        try:
+            for format, path in zip(formats, paths):
+                if cache:
+                    tmp = self._temp_path(path)
+                else:
+                    tmp = path
+                tmps.append(tmp)
+                args += ['-T%s' % format, '-o%s' % tmp]
+            self._run(args, chunks, None)
+            for tmp, path in zip(tmps, paths):
+                self._finish(tmp, path)
+        finally:
+            for tmp in tmps:
+                if cache:
+                    self._discard(tmp)
+
+    def _run_to(self, args, input, path):
+        """Run `args` writing its standard output to the cache file `path`."""
+        tmp = self._temp_path(path)
+        try:
+            f = open(tmp, 'wb')
+            try:
+                self._run(args, input, f)
+            finally:
+                f.close()
+            self._finish(tmp, path)
+        finally:
+            self._discard(tmp)
+
+    def _run(self, args, input, output):
+        """Run `args` with `input`, an open file or an iterable of strings, as
+        its standard input, and `output`, an open file or `None`, as its
+        standard output.
+
+        Raises `RenderError` if the process is killed after `render_timeout`
+        seconds.
+        """
+        start = time.time()
+        err = tempfile.TemporaryFile()
+        try:
+            if hasattr(input, 'fileno'):
+                stdin = input
+            else:
+                stdin = subprocess.PIPE
+            if output is None:
+                output = err
+            proc = subprocess.Popen(args, stdin=stdin, stdout=output, stderr=err)
+            killed = []
+            def kill():
+                killed.append(True)
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+            timer = threading.Timer(self.timeout, kill)
+            timer.start()
+            try:
+                if stdin is subprocess.PIPE:
+                    try:
+                        try:
+                            for chunk in input:
+                                proc.stdin.write(chunk)
+                        except (IOError, OSError), e:
+                            # The process exited or was killed before reading
+                            # all of its input
+                            self.log.debug('MasterTickets: Could not write to %s: %s',
+                                           args[0], e)
+                    finally:
+                        try:
+                            proc.stdin.close()
+                        except (IOError, OSError):
+                            pass
+                proc.wait()
+            finally:
+                timer.cancel()
+                count('renders', 1, time.time() - start)
+            if killed:
+                self._slots.acquire()
+                try:
+                    self._timeouts += 1
+                finally:
+                    self._slots.release()
+                self.log.warning('MasterTickets: Killed %s after %d seconds',
+                                 args[0], self.timeout)
+                raise RenderError('Rendering the graph took too long')
+            err.seek(0)
+            error = err.read()
+            if error:
+                self.log.debug('MasterTickets: Error from %s: %s', args[0], error)
+        finally:
+            err.close()
+
+    def _temp_path(self, path):
+        dir = os.path.dirname(path)
+        if not os.path.isdir(dir):
+            try:
+                os.makedirs(dir)
+            except OSError:
+                if not os.path.isdir(dir):
+                    raise
+        fd, tmp = tempfile.mkstemp(dir=dir, prefix=self.TEMP_PREFIX)
+        os.close(fd)
+        return tmp
+
+    def _finish(self, tmp, path):
+        """Move the output in `tmp` to `path`, unless it is empty."""
+        if not os.path.getsize(tmp):
+            raise RenderError('The graph could not be rendered')
+        if tmp == path:
+            return
+        try:
+            os.rename(tmp, path)
+        except OSError, e:
+            # Another process may have won the race on platforms where
+            # rename does not replace an existing file
+            self.log.debug('MasterTickets: Could not cache %s: %s', path, e)
+
+    def _discard(self, tmp):
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+    def _maybe_evict(self):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if now - self._last_evict < self.EVICT_INTERVAL:
+                return
+            self._last_evict = now
+        finally:
+            self._lock.release()
+
+        dir = self._cache_dir()
+        entries = []
+        for name in os.listdir(dir):
+            path = os.path.join(dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if name.startswith(self.TEMP_PREFIX):
+                # Renders in progress, possibly in other processes
+                if st.st_mtime < now - self.TEMP_MAX_AGE:
+                    self._discard(path)
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+
+        total = sum([size for mtime, size, path in entries])
+        max_size = self.cache_size * 1024 * 1024
+        min_mtime = now - self.cache_max_age * 24 * 3600
+        evicted = 0
+        for mtime, size, path in entries:
+            if total <= max_size and mtime >= min_mtime:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        if evicted:
+            self.log.debug('MasterTickets: Evicted %d graphs from the render cache',
+                           evicted)
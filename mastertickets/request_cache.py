@@ -0,0 +1,47 @@
+"""Per-request cache of ticket links and attributes.
+
+One request can reach the plugin through several hooks, e.g. a ticket
+submit goes through both `validate_ticket` implementations and then
+`ticket_changed`, and each of them would otherwise read the same links and
+tickets again. `MasterTicketsModule.pre_process_request` starts a cache for
+the current thread that `TicketLinks`, `load_ticket_attrs` and
+`open_blocker_counts` then share until the next request starts.
+
+Outside of a request, e.g. in trac-admin or background threads, there is no
+cache and every lookup goes to the database.
+"""
+import threading
+
+_local = threading.local()
+
+def begin():
+    """Start an empty cache for the request handled by this thread."""
+    _local.cache = {'links': {}, 'attrs': {}, 'open_blockers': {}}
+
+def end():
+    """Drop the cache of this thread."""
+    _local.cache = None
+
+def current():
+    """Return the cache of this thread, or `None` outside of a request.
+
+    It holds `links` as `{id: (blocking, blocked_by)}`, `attrs` as
+    `{id: {field: value}}` with `None` for missing tickets, and
+    `open_blockers` as `{id: count}`.
+    """
+    return getattr(_local, 'cache', None)
+
+def invalidate(ids=None):
+    """Forget the links, attributes and blocker counts of the tickets in
+    `ids`, or everything if `ids` is `None`."""
+    cache = current()
+    if cache is None:
+        return
+    if ids is None:
+        for name in ('links', 'attrs', 'open_blockers'):
+            cache[name].clear()
+        return
+    for n in ids:
+        cache['links'].pop(int(n), None)
+        cache['attrs'].pop(int(n), None)
+        cache['open_blockers'].pop(int(n), None)
@@ -0,0 +1,200 @@
+import threading
+import time
+
+from trac.core import *
+from trac.config import IntOption
+from trac.db.util import IterableCursor
+from trac.util.compat import sorted
+
+_local = threading.local()
+
+def count(name, n=1, elapsed=0.0):
+    """Add `n` to counter `name`, and `elapsed` seconds to its time, for the
+    entry point running in this thread. Does nothing outside of one."""
+    scope = getattr(_local, 'scope', None)
+    if scope is not None:
+        scope.add(name, n, elapsed)
+
+
+class Scope(object):
+    """The counters of one call of a plugin entry point."""
+
+    __slots__ = ('entry', 'path', 'start', 'counts', 'times')
+
+    def __init__(self, entry, path):
+        self.entry = entry
+        self.path = path
+        self.start = time.time()
+        self.counts = {}
+        self.times = {}
+
+    def add(self, name, n, elapsed):
+        self.counts[name] = self.counts.get(name, 0) + n
+        self.times[name] = self.times.get(name, 0.0) + elapsed
+
+
+def _timed(func):
+    def wrapper(cursor, *args, **kwargs):
+        if getattr(_local, 'scope', None) is None or getattr(_local, 'in_sql', False):
+            return func(cursor, *args, **kwargs)
+        _local.in_sql = True
+        start = time.time()
+        try:
+            return func(cursor, *args, **kwargs)
+        finally:
+            _local.in_sql = False
+            count('sql', 1, time.time() - start)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper._mastertickets_timed = True
+    return wrapper
+
+_hook_lock = threading.Lock()
+_hook_users = 0
+_unhooked = {} # {name: original method of IterableCursor}
+
+def _hook_cursor():
+    """Time the statements run through Trac's cursor wrapper while any entry
+    point is active in some thread. Statements of other threads only pay an
+    attribute lookup meanwhile."""
+    global _hook_users
+    _hook_lock.acquire()
+    try:
+        if not _hook_users:
+            for name in ('execute', 'executemany'):
+                method = IterableCursor.__dict__[name]
+                if not getattr(method, '_mastertickets_timed', False):
+                    _unhooked[name] = method
+                    setattr(IterableCursor, name, _timed(method))
+        _hook_users += 1
+    finally:
+        _hook_lock.release()
+
+def _unhook_cursor():
+    """Restore Trac's cursor wrapper once no entry point is active, unless
+    something else has wrapped it since."""
+    global _hook_users
+    _hook_lock.acquire()
+    try:
+        _hook_users -= 1
+        if not _hook_users:
+            for name, method in _unhooked.items():
+                if getattr(IterableCursor.__dict__[name], '_mastertickets_timed', False):
+                    setattr(IterableCursor, name, method)
+                    del _unhooked[name]
+    finally:
+        _hook_lock.release()
+
+
+class MasterTicketsStats(Component):
+    """Counts the work done by each call of the plugin's entry points.
+
+    SQL statements, ticket loads, graph walk nodes and renderer runs are
+    attributed to the entry point active in the current thread. Calls
+    slower than `stats_log_threshold` are logged with their counters, and
+    cumulative histograms are kept for `/depgraph/_stats`.
+    """
+
+    log_threshold = IntOption('mastertickets', 'stats_log_threshold', default=1000,
+        doc='Log the queries, ticket loads, walked nodes and renders of any '
+            'request handled by the plugin that takes longer than this many '
+            'milliseconds. Set to 0 to disable.')
+
+    # Upper bounds of the histogram buckets
+    TIME_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000) # ms
+    SQL_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000) # statements
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._since = time.time()
+
+    # Public methods
+    def start(self, entry, req=None):
+        """Start counting for a call of `entry` in this thread, and return
+        the scope to pass to `finish`.
+
+        Returns `None` if another entry point is already active, whose
+        counters then include this call.
+        """
+        if getattr(_local, 'scope', None) is not None:
+            return None
+        # Requests made up by background threads and scripts may lack a path
+        _local.scope = Scope(entry, getattr(req, 'path_info', None) or '')
+        _hook_cursor()
+        return _local.scope
+
+    def finish(self, scope):
+        """Stop counting for `scope` and add it to the totals."""
+        if scope is None:
+            return
+        _local.scope = None
+        _unhook_cursor()
+        elapsed = (time.time() - scope.start) * 1000
+        sql = scope.counts.get('sql', 0)
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(scope.entry)
+            if entry is None:
+                entry = self._entries[scope.entry] = {
+                    'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'counters': {},
+                    'time_histogram': [0] * (len(self.TIME_BUCKETS) + 1),
+                    'sql_histogram': [0] * (len(self.SQL_BUCKETS) + 1),
+                }
+            entry['calls'] += 1
+            entry['total_ms'] += elapsed
+            entry['max_ms'] = max(entry['max_ms'], elapsed)
+            entry['time_histogram'][self._bucket(self.TIME_BUCKETS, elapsed)] += 1
+            entry['sql_histogram'][self._bucket(self.SQL_BUCKETS, sql)] += 1
+            for name, n in scope.counts.iteritems():
+                counter = entry['counters'].setdefault(name, {'count': 0, 'ms': 0.0})
+                counter['count'] += n
+                counter['ms'] += scope.times[name] * 1000
+        finally:
+            self._lock.release()
+
+        if self.log_threshold and elapsed >= self.log_threshold:
+            counters = []
+            for name in sorted(scope.counts):
+                if scope.times[name]:
+                    counters.append('%d %s in %dms' % (scope.counts[name], name,
+                                                       scope.times[name] * 1000))
+                else:
+                    counters.append('%d %s' % (scope.counts[name], name))
+            self.log.info('MasterTickets: %s %s took %dms: %s', scope.entry,
+                          scope.path, elapsed, ', '.join(counters) or 'no counters')
+
+    def snapshot(self):
+        """Return the cumulative counters of every entry point."""
+        def histogram(bounds, counts):
+            # Each bucket counts the calls up to its bound, as in Prometheus
+            buckets = []
+            total = 0
+            for bound, n in zip(list(bounds) + [None], counts):
+                total += n
+                buckets.append({'le': bound, 'count': total})
+            return buckets
+        self._lock.acquire()
+        try:
+            entries = {}
+            for name, entry in self._entries.iteritems():
+                entries[name] = {
+                    'calls': entry['calls'],
+                    'total_ms': entry['total_ms'],
+                    'avg_ms': entry['total_ms'] / entry['calls'],
+                    'max_ms': entry['max_ms'],
+                    'time_histogram': histogram(self.TIME_BUCKETS, entry['time_histogram']),
+                    'sql_histogram': histogram(self.SQL_BUCKETS, entry['sql_histogram']),
+                    'counters': dict([(k, dict(v)) for k, v in entry['counters'].iteritems()]),
+                }
+            return {'since': self._since, 'entry_points': entries}
+        finally:
+            self._lock.release()
+
+    # Internal methods
+    def _bucket(self, bounds, value):
+        for i, bound in enumerate(bounds):
+            if value <= bound:
+                return i
+        return len(bounds)
@@ -0,0 +1,15 @@
+import unittest
+
+from mastertickets.tests import admin, api, model, prerender, web_ui
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(admin.suite())
+    suite.addTest(api.suite())
+    suite.addTest(model.suite())
+    suite.addTest(prerender.suite())
+    suite.addTest(web_ui.suite())
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,102 @@
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+from trac.ticket.model import Ticket
+
+from mastertickets.admin import MasterTicketsAdminCommands
+from mastertickets.model import closure_current, get_generation, \
+                                open_blocker_counts, rebuild_closure
+from mastertickets.tests.environment import EnvironmentTestCase
+
+
+class MasterTicketsAdminCommandsTestCase(EnvironmentTestCase):
+
+    options = [('mastertickets', 'use_closure', 'true')]
+
+    def setUp(self):
+        EnvironmentTestCase.setUp(self)
+        for summary in ('Third', 'Fourth', 'Fifth'):
+            self.insert_ticket(summary)
+        db = self.env.get_db_cnx()
+        rebuild_closure(db)
+        db.commit()
+        self.admin = MasterTicketsAdminCommands(self.env)
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        EnvironmentTestCase.tearDown(self)
+
+    def _write(self, name, content):
+        filename = os.path.join(self.path, name)
+        f = open(filename, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        return filename
+
+    def _links(self):
+        cursor = self.env.get_read_db().cursor()
+        cursor.execute('SELECT source, dest FROM mastertickets')
+        return sorted([(int(s), int(d)) for s, d in cursor.fetchall()])
+
+    def test_import(self):
+        generation = get_generation(self.env.get_read_db())
+        self.admin.IMPORT_BATCH_SIZE = 2
+        # 4 -> 2 would close a cycle and #9 does not exist
+        self.admin._do_import('csv', self._write('links.csv',
+            'source,dest\n2,3\n3,4\n4,2\n9,1\n4,5\n'))
+
+        self.assertEqual([(1, 2), (2, 3), (3, 4), (4, 5)], self._links())
+        self.assertEqual('2', Ticket(self.env, 3)['blockedby'])
+        self.assertEqual('4', Ticket(self.env, 3)['blocking'])
+        self.assertEqual({2: 1, 3: 1, 4: 1, 5: 1},
+                         open_blocker_counts(self.env, [1, 2, 3, 4, 5]))
+        db = self.env.get_read_db()
+        self.assertTrue(closure_current(db))
+        # One generation per batch that added links
+        self.assertEqual(generation + 2, get_generation(db))
+        cursor = db.cursor()
+        cursor.execute('SELECT depth FROM mastertickets_closure '
+                       'WHERE ancestor=1 AND descendant=5')
+        self.assertEqual([(4,)], cursor.fetchall())
+        self.assertTrue('cycle' in sys.stderr.getvalue())
+
+    def test_export_import(self):
+        self.link(2, 3)
+        filename = os.path.join(self.path, 'links.json')
+        self.admin._do_export('json', filename)
+        self.unlink(1, 2)
+        self.unlink(2, 3)
+        self.assertEqual([], self._links())
+
+        self.admin._do_import('json', filename)
+        self.assertEqual([(1, 2), (2, 3)], self._links())
+        self.assertEqual('1', Ticket(self.env, 2)['blockedby'])
+        self.assertEqual('3', Ticket(self.env, 2)['blocking'])
+
+    def test_resync(self):
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("UPDATE ticket_custom SET value='3' "
+                       "WHERE ticket=2 AND name='blockedby'")
+        db.commit()
+
+        self.admin._do_resync('--dry-run')
+        self.assertTrue('#2 blockedby: "3" should be "1"' in sys.stdout.getvalue())
+        self.assertEqual('3', Ticket(self.env, 2)['blockedby'])
+
+        self.admin._do_resync('2', '2')
+        self.assertEqual('1', Ticket(self.env, 2)['blockedby'])
+        self.assertEqual('', Ticket(self.env, 2)['blocking'] or '')
+
+
+def suite():
+    return unittest.makeSuite(MasterTicketsAdminCommandsTestCase, 'test')
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
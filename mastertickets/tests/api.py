@@ -0,0 +1,92 @@
+import unittest
+
+from mastertickets import db_default
+from mastertickets.api import MasterTicketsSystem
+from mastertickets.model import open_blocker_counts
+from mastertickets.tests.environment import EnvironmentTestCase
+
+
+class UpgradeTestCase(EnvironmentTestCase):
+
+    def setUp(self):
+        EnvironmentTestCase.setUp(self)
+        self.insert_ticket('Third')
+        self.link(2, 3)
+        self.system = MasterTicketsSystem(self.env)
+        self.system.UPGRADE_BATCH_SIZE = 1
+        self.db = self.env.get_db_cnx()
+
+    def _execute(self, *statements):
+        cursor = self.db.cursor()
+        for sql in statements:
+            cursor.execute(sql)
+        self.db.commit()
+
+    def _fetch(self, sql):
+        cursor = self.db.cursor()
+        cursor.execute(sql)
+        return sorted(cursor.fetchall())
+
+    def _set_version(self, version):
+        self._execute("UPDATE system SET value='%d' WHERE name='mastertickets'" % version)
+
+    def _upgrade(self):
+        self.assertTrue(self.system.environment_needs_upgrade(self.db))
+        self.system.upgrade_environment(self.db)
+        self.db.commit()
+        self.assertFalse(self.system.environment_needs_upgrade(self.db))
+        self.assertEqual(None, self.system._get_upgrade_state(self.db))
+
+    def _indexes(self):
+        return [name for name, in self._fetch("SELECT name FROM sqlite_master "
+                                              "WHERE type='index' AND tbl_name='mastertickets' "
+                                              "AND sql IS NOT NULL")]
+
+    def test_add_index(self):
+        self._execute('DROP INDEX mastertickets_dest_idx')
+        self._set_version(4)
+        self._upgrade()
+        self.assertEqual(['mastertickets_dest_idx'], self._indexes())
+        self.assertEqual([(1, 2), (2, 3)], self._fetch('SELECT * FROM mastertickets'))
+
+    def test_resume_index(self):
+        self._set_version(4)
+        self.system._set_upgrade_state(self.db, 'mastertickets', 'index')
+        self.db.commit()
+        self._upgrade()
+        self.assertEqual(['mastertickets_dest_idx'], self._indexes())
+
+    def test_upgrade_from_text_columns(self):
+        self._execute('DROP TABLE mastertickets',
+                      'DROP TABLE mastertickets_closure',
+                      'DROP TABLE mastertickets_blockers',
+                      'CREATE TABLE mastertickets (source text, dest text)',
+                      "INSERT INTO mastertickets VALUES ('1', '2')",
+                      "INSERT INTO mastertickets VALUES ('2', '3')")
+        self._set_version(1)
+        self._upgrade()
+        self.assertEqual([(1, 2), (2, 3)], self._fetch('SELECT * FROM mastertickets'))
+        self.assertEqual(['mastertickets_dest_idx'], self._indexes())
+        self.assertEqual({2: 1, 3: 1}, open_blocker_counts(self.env, [1, 2, 3]))
+        self.assertEqual(db_default.version, int(self._fetch(
+            "SELECT value FROM system WHERE name='mastertickets'")[0][0]))
+
+    def test_resume_recreate(self):
+        # Interrupted after the backup was complete and the table dropped
+        self._execute('CREATE TABLE mastertickets_backup (source text, dest text)',
+                      'INSERT INTO mastertickets_backup SELECT source, dest FROM mastertickets',
+                      'DROP TABLE mastertickets')
+        self._set_version(1)
+        self.system._set_upgrade_state(self.db, 'mastertickets', 'recreate')
+        self.db.commit()
+        self._upgrade()
+        self.assertEqual([(1, 2), (2, 3)], self._fetch('SELECT * FROM mastertickets'))
+        self.assertEqual([], self._fetch("SELECT name FROM sqlite_master "
+                                         "WHERE name='mastertickets_backup'"))
+
+
+def suite():
+    return unittest.makeSuite(UpgradeTestCase, 'test')
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
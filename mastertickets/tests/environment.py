@@ -0,0 +1,113 @@
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from trac.env import Environment
+from trac.test import MockPerm
+from trac.ticket.model import Ticket
+from trac.util.datefmt import utc
+from trac.web.api import Request, RequestDone
+
+from mastertickets.api import MasterTicketsSystem # creates the plugin's tables
+from mastertickets.model import TicketLinks
+
+# Stands in for dot, writing a placeholder to each output file
+FAKE_DOT = """#!%s
+import sys
+sys.stdin.read()
+for arg in sys.argv[1:]:
+    if arg.startswith('-o'):
+        open(arg[2:], 'wb').write('rendered')
+"""
+
+
+class EnvironmentTestCase(unittest.TestCase):
+    """Runs against a new environment with the plugin enabled, a stand-in
+    for dot, and ticket #1 blocking #2."""
+
+    # Extra `(section, name, value)` options for the environment
+    options = []
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='mastertickets-test-')
+        dot = os.path.join(self.path, 'dot')
+        f = open(dot, 'w')
+        try:
+            f.write(FAKE_DOT % sys.executable)
+        finally:
+            f.close()
+        os.chmod(dot, stat.S_IRWXU)
+        self.env = Environment(os.path.join(self.path, 'env'), create=True, options=[
+            ('trac', 'database', 'sqlite:db/trac.db'),
+            ('components', 'mastertickets.*', 'enabled'),
+            ('mastertickets', 'dot_path', dot),
+            ('mastertickets', 'prerender_workers', '0'),
+            ('mastertickets', 'prerender_delay', '0'),
+        ] + self.options)
+        self.insert_ticket('Blocker')
+        self.insert_ticket('Blocked')
+        self.link(1, 2)
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.path)
+
+    def insert_ticket(self, summary, **fields):
+        tkt = Ticket(self.env)
+        tkt['summary'] = summary
+        tkt['reporter'] = 'test'
+        tkt['status'] = 'new'
+        for name, value in fields.items():
+            tkt[name] = value
+        return tkt.insert()
+
+    def link(self, source, dest):
+        """Make ticket `source` block `dest` by editing its field."""
+        self._save_blocking(source, TicketLinks(self.env, source).blocking | set([dest]))
+
+    def unlink(self, source, dest):
+        self._save_blocking(source, TicketLinks(self.env, source).blocking - set([dest]))
+
+    def _save_blocking(self, tkt_id, ids):
+        tkt = Ticket(self.env, tkt_id)
+        tkt['blocking'] = ', '.join([str(n) for n in sorted(ids)])
+        tkt.save_changes('test', '')
+
+    def request(self, handler, path, query='', headers={}):
+        """Let `handler` process a GET request for `path`.
+
+        Returns what `process_request` returned, `None` if it sent the
+        response itself, and the response as a dictionary with `status`,
+        `headers` and `body`.
+        """
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+                   'QUERY_STRING': query, 'SCRIPT_NAME': '/trac',
+                   'SERVER_NAME': 'example.org', 'SERVER_PORT': '80',
+                   'wsgi.url_scheme': 'http', 'wsgi.input': StringIO()}
+        for name, value in headers.items():
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+        response = {'status': None, 'headers': {}, 'body': []}
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split()[0])
+            response['headers'] = dict(headers)
+            return response['body'].append
+        req = Request(environ, start_response)
+        req.authname = 'anonymous'
+        req.perm = MockPerm()
+        req.session = {}
+        req.tz = utc
+        req.locale = None
+        req.chrome = {'ctxtnav': [], 'links': {}, 'scripts': []}
+        try:
+            result = handler.process_request(req)
+        except RequestDone:
+            result = None
+        else:
+            # Headers of a page that is still to be rendered
+            response['headers'] = dict(req._outheaders)
+        response['body'] = ''.join(response['body'])
+        return result, response
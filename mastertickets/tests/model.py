@@ -0,0 +1,107 @@
+import unittest
+
+from trac.ticket.model import Ticket
+
+from mastertickets.model import closure_current, find_cycle, \
+                                links_within, open_blocker_counts, rebuild_closure
+from mastertickets.tests.environment import EnvironmentTestCase
+
+
+class BlockerCountsTestCase(EnvironmentTestCase):
+
+    def _set_status(self, tkt_id, status):
+        tkt = Ticket(self.env, tkt_id)
+        tkt['status'] = status
+        tkt.save_changes('test', '')
+
+    def test_link(self):
+        self.assertEqual({2: 1}, open_blocker_counts(self.env, [1, 2]))
+        self.insert_ticket('Other blocker')
+        self.link(3, 2)
+        self.assertEqual({2: 2}, open_blocker_counts(self.env, [2]))
+
+        self.unlink(1, 2)
+        self.assertEqual({2: 1}, open_blocker_counts(self.env, [2]))
+
+    def test_close_blocker(self):
+        self._set_status(1, 'closed')
+        self.assertEqual({}, open_blocker_counts(self.env, [2]))
+        self._set_status(1, 'reopened')
+        self.assertEqual({2: 1}, open_blocker_counts(self.env, [2]))
+
+
+class ClosureTestCase(EnvironmentTestCase):
+
+    options = [('mastertickets', 'use_closure', 'true')]
+
+    def setUp(self):
+        EnvironmentTestCase.setUp(self)
+        # 1 -> 2 -> 3 -> 4
+        for summary in ('Third', 'Fourth'):
+            self.insert_ticket(summary)
+        self.link(2, 3)
+        self.link(3, 4)
+
+    def _closure(self):
+        cursor = self.env.get_read_db().cursor()
+        cursor.execute('SELECT ancestor, descendant, depth FROM mastertickets_closure')
+        return sorted(cursor.fetchall())
+
+    def _rebuild(self):
+        db = self.env.get_db_cnx()
+        rebuild_closure(db)
+        db.commit()
+
+    def test_rebuild(self):
+        self.assertFalse(closure_current(self.env.get_read_db()))
+        self._rebuild()
+        self.assertTrue(closure_current(self.env.get_read_db()))
+        self.assertEqual([(1, 2, 1), (1, 3, 2), (1, 4, 3), (2, 3, 1), (2, 4, 2),
+                          (3, 4, 1)], self._closure())
+
+    def test_update(self):
+        self._rebuild()
+        self.unlink(2, 3)
+        self.assertTrue(closure_current(self.env.get_read_db()))
+        self.assertEqual([(1, 2, 1), (3, 4, 1)], self._closure())
+
+        self.link(1, 3)
+        self.assertEqual([(1, 2, 1), (1, 3, 1), (1, 4, 2), (3, 4, 1)], self._closure())
+
+    def test_stale(self):
+        self._rebuild()
+        self.env.config.set('mastertickets', 'use_closure', 'false')
+        self.unlink(2, 3)
+        self.env.config.set('mastertickets', 'use_closure', 'true')
+        self.link(2, 3)
+        self.assertFalse(closure_current(self.env.get_read_db()))
+
+    def test_find_cycle(self):
+        for closure in (False, True):
+            self.assertEqual([1, 2, 3, 4], find_cycle(self.env, None, [1], [4],
+                                                      closure=closure))
+            self.assertEqual([3, 4], find_cycle(self.env, 1, [3], [4],
+                                                closure=closure))
+            self.assertEqual(None, find_cycle(self.env, None, [4], [1],
+                                              closure=closure))
+            # The stored links of ticket 3 are replaced by the new ones
+            self.assertEqual(None, find_cycle(self.env, 3, [2], [4],
+                                              closure=closure))
+            self._rebuild()
+
+    def test_links_within(self):
+        expected = {1: set([2]), 2: set([3]), 3: set()}
+        self.assertEqual(expected, links_within(self.env, 2, 1))
+        self.assertEqual(expected, links_within(self.env, 2, 1, closure=True))
+        self._rebuild()
+        self.assertEqual(expected, links_within(self.env, 2, 1, closure=True))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(BlockerCountsTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(ClosureTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
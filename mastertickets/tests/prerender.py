@@ -0,0 +1,42 @@
+import shutil
+import time
+import unittest
+
+from trac.test import Mock
+from trac.web.href import Href
+
+from mastertickets.macro_provider import MasterTicketsMacros
+from mastertickets.prerender import GraphPrerenderer
+from mastertickets.render import GraphRenderer
+from mastertickets.tests.environment import EnvironmentTestCase
+
+
+class GraphPrerendererTestCase(EnvironmentTestCase):
+
+    options = [('mastertickets', 'prerender_workers', '1')]
+
+    def _expand(self):
+        href = Href('/trac')
+        req = Mock(base_url='http://example.org/trac', href=href, path_info='/wiki')
+        macros = MasterTicketsMacros(self.env)
+        macros.expand_macro(Mock(req=req, href=href), 'DepGraph', '')
+        return macros._memo.values()[0][2]
+
+    def test_render_macros(self):
+        renderer = GraphRenderer(self.env)
+        key = self._expand()
+        shutil.rmtree(renderer._cache_dir())
+        self.assertFalse(renderer.has(key))
+
+        GraphPrerenderer(self.env).schedule([])
+        deadline = time.time() + 10
+        while not renderer.has(key) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(renderer.has(key))
+
+
+def suite():
+    return unittest.makeSuite(GraphPrerendererTestCase, 'test')
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
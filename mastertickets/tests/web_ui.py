@@ -0,0 +1,137 @@
+import unittest
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from trac.core import TracError
+from trac.resource import ResourceNotFound
+from trac.web.api import HTTPBadRequest
+
+from mastertickets.tests.environment import EnvironmentTestCase
+from mastertickets.web_ui import MasterTicketsModule
+
+
+class MasterTicketsModuleTestCase(EnvironmentTestCase):
+
+    def setUp(self):
+        EnvironmentTestCase.setUp(self)
+        # 1 -> 2 -> 3 -> 4
+        for summary in ('Third', 'Fourth'):
+            self.insert_ticket(summary)
+        self.link(2, 3)
+        self.link(3, 4)
+        self.module = MasterTicketsModule(self.env)
+
+    def _send(self, path, query='', headers={}):
+        result, response = self.request(self.module, path, query, headers)
+        self.assertEqual(None, result)
+        self.assertEqual(str(len(response['body'])),
+                         response['headers']['Content-Length'])
+        return response
+
+    def test_json(self):
+        response = self._send('/depgraph/2', 'format=json')
+        self.assertEqual(200, response['status'])
+        self.assertTrue(response['headers']['Content-Type'].startswith('application/json'))
+        data = json.loads(response['body'])
+        self.assertEqual([(1, 1), (2, 0), (3, 1), (4, 2)],
+                         sorted([(n['id'], n['depth']) for n in data['nodes']]))
+        self.assertEqual([(1, 2), (2, 3), (3, 4)],
+                         sorted([(e['source'], e['dest']) for e in data['edges']]))
+        self.assertFalse(data['truncated'])
+
+    def test_json_truncated(self):
+        data = json.loads(self._send('/depgraph/2', 'format=json&depth=1')['body'])
+        self.assertEqual([1, 2, 3], sorted([n['id'] for n in data['nodes']]))
+        self.assertTrue(data['truncated'])
+
+        data = json.loads(self._send('/depgraph/2', 'format=json&depth=2')['body'])
+        self.assertEqual([1, 2, 3, 4], sorted([n['id'] for n in data['nodes']]))
+        self.assertFalse(data['truncated'])
+
+        data = json.loads(self._send('/depgraph/2', 'format=json&max_nodes=2')['body'])
+        self.assertEqual(2, len(data['nodes']))
+        self.assertTrue(data['truncated'])
+
+    def test_json_direction(self):
+        data = json.loads(self._send('/depgraph/2',
+                                     'format=json&direction=blocking')['body'])
+        self.assertEqual([2, 3, 4], sorted([n['id'] for n in data['nodes']]))
+
+    def test_ndjson(self):
+        response = self._send('/depgraph/2', 'format=ndjson')
+        self.assertTrue(response['headers']['Content-Type'].startswith('application/x-ndjson'))
+        lines = [json.loads(line) for line in response['body'].splitlines()]
+        self.assertEqual([1, 2, 3, 4],
+                         sorted([l['id'] for l in lines if l['type'] == 'node']))
+        self.assertEqual(3, len([l for l in lines if l['type'] == 'edge']))
+        self.assertEqual({'type': 'end', 'truncated': False}, lines[-1])
+
+    def test_text(self):
+        response = self._send('/depgraph/2', 'format=text')
+        self.assertEqual(200, response['status'])
+        self.assertTrue(response['headers']['Content-Type'].startswith('text/plain'))
+        self.assertTrue(response['body'].startswith('digraph'))
+        self.assertTrue('2 -> 3;' in response['body'])
+
+    def test_invalid_format(self):
+        self.assertRaises(HTTPBadRequest, self.request, self.module,
+                          '/depgraph/2', 'format=../../png')
+
+    def test_invalid_ticket(self):
+        self.assertRaises(ResourceNotFound, self.request, self.module,
+                          '/depgraph/abc')
+        self.assertRaises(ResourceNotFound, self.request, self.module,
+                          '/depgraph/99', 'format=json')
+
+    def test_not_modified(self):
+        response = self._send('/depgraph/2', 'format=text')
+        etag = response['headers']['ETag']
+        self.assertTrue('Last-Modified' in response['headers'])
+        response = self._send('/depgraph/2', 'format=text', {'If-None-Match': etag})
+        self.assertEqual(304, response['status'])
+
+        self.link(4, 1)
+        response = self._send('/depgraph/2', 'format=text', {'If-None-Match': etag})
+        self.assertEqual(200, response['status'])
+
+    def test_page_not_modified(self):
+        result, response = self.request(self.module, '/depgraph/2')
+        self.assertEqual('depgraph.html', result[0])
+        etag = response['headers']['ETag']
+
+        built = []
+        build_graph = self.module._build_graph
+        def _build_graph(*args):
+            built.append(args)
+            return build_graph(*args)
+        self.module._build_graph = _build_graph
+        response = self._send('/depgraph/2', '', {'If-None-Match': etag})
+        self.assertEqual(304, response['status'])
+        self.assertEqual([], built)
+
+    def test_ready(self):
+        response = self._send('/depgraph/ready', 'format=json')
+        self.assertEqual([1], [t['id'] for t in json.loads(response['body'])])
+
+    def test_ready_max(self):
+        self.insert_ticket('Unblocked')
+        for max in ('0', '-1'):
+            response = self._send('/depgraph/ready', 'format=json&max=' + max)
+            self.assertEqual(1, len(json.loads(response['body'])))
+        response = self._send('/depgraph/ready', 'format=json&max=1&page=2')
+        self.assertEqual([5], [t['id'] for t in json.loads(response['body'])])
+        result, response = self.request(self.module, '/depgraph/ready', 'max=0')
+        self.assertEqual(1, result[1]['max'])
+        result, response = self.request(self.module, '/depgraph/ready', 'max=5000')
+        self.assertEqual(MasterTicketsModule.READY_PAGE_MAX, result[1]['max'])
+        self.assertRaises(TracError, self.request, self.module,
+                          '/depgraph/ready', 'max=x')
+
+
+def suite():
+    return unittest.makeSuite(MasterTicketsModuleTestCase, 'test')
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -1,18 +1,18 @@
-from trac.ticket.model import Ticket
-from trac.resource import ResourceNotFound
 from trac.util.compat import set
 from genshi.builder import tag
 
+from model import load_ticket_attrs
+
 def linkify_ids(env, req, ids):
+    attrs = load_ticket_attrs(env, ids, ('status', 'summary'))
     data = []
     for id in sorted(ids, key=lambda x: int(x)):
-        try:
-            tkt = Ticket(env, id)
-            data.append(tag.a('#%s'%tkt.id, href=req.href.ticket(tkt.id), class_='%s ticket'%tkt['status'], title=tkt['summary']))
-        except ResourceNotFound:
+        tkt = attrs.get(int(id))
+        if tkt is not None:
+            data.append(tag.a('#%s'%id, href=req.href.ticket(id), class_='%s ticket'%tkt['status'], title=tkt['summary']))
+        else:
             data.append('#%s'%id)
         data.append(', ')
     if data:
         del data[-1] # Remove the last comma if needed
     return tag.span(*data)
-
@@ -1,4 +1,11 @@
-import subprocess, time
+import os
+import time
+import threading
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 
 from pkg_resources import resource_filename
 from genshi.core import Markup, START, END, TEXT
@@ -6,18 +13,30 @@ from genshi.builder import tag
 from genshi.filters.transform import Transformer
 
 from trac.core import *
+from trac.config import IntOption
 from trac.web.api import IRequestHandler, IRequestFilter, ITemplateStreamFilter
 from trac.web.chrome import ITemplateProvider, add_stylesheet, add_script, \
                             add_ctxtnav
 from trac.ticket.api import ITicketManipulator
 from trac.ticket.model import Ticket
-from trac.config import Option, BoolOption
+from trac.resource import ResourceNotFound
+from trac.web.api import RequestDone, HTTPBadRequest
+from trac.util.presentation import to_json
+from trac.util.datefmt import http_date, from_utimestamp
 from trac.util.html import html, Markup
-from trac.util.compat import set, sorted, partial
+from trac.util.compat import set, sorted
 
 import graphviz
 from util import *
-from model import TicketLinks
+from index import DependencyIndex
+from render import GraphRenderer, RenderError
+import request_cache
+from stats import MasterTicketsStats, count
+from prerender import GraphPrerenderer
+from api import MasterTicketsSystem
+from model import TicketLinks, load_ticket_attrs, last_changed, links_within, \
+                  open_blocker_counts, ready_tickets, walk_links, link_status_counts, \
+                  link_page
 
 class MasterTicketsModule(Component):
     """Provides support for ticket dependencies."""
@@ -25,76 +44,117 @@ class MasterTicketsModule(Component):
     implements(IRequestHandler, IRequestFilter, ITemplateStreamFilter, 
                ITemplateProvider, ITicketManipulator)
     
-    dot_path = Option('mastertickets', 'dot_path', default='dot',
-                      doc='Path to the dot executable.')
-    gs_path = Option('mastertickets', 'gs_path', default='gs',
-                     doc='Path to the ghostscript executable.')
-    use_gs = BoolOption('mastertickets', 'use_gs', default=False,
-                        doc='If enabled, use ghostscript to produce nicer output.')
+    link_field_limit = IntOption('mastertickets', 'link_field_limit', default=50,
+        doc='Number of tickets shown in the `blocking` and `blockedby` fields '
+            'of the ticket page. The others are counted and can be loaded on '
+            'demand. Set to 0 to show all of them.')
     
     FIELD_XPATH = '//div[@id="ticket"]/table[@class="properties"]//td[@headers="h_%s"]/text()'
     fields = set(['blocking', 'blockedby'])
     
+    # Number of tickets loaded and encoded at a time by the JSON graph API
+    JSON_BATCH_SIZE = 100
+    
+    # Largest page of links returned by /depgraph/<id>/links
+    LINK_PAGE_MAX = 500
+    
+    # Largest page of tickets listed by /depgraph/ready
+    READY_PAGE_MAX = 1000
+    
+    # Bytes read at a time when sending a rendered graph
+    SEND_CHUNK_SIZE = 64 * 1024
+    
+    # Number of depgraph pages whose image render key is remembered
+    PAGE_MEMO_SIZE = 100
+    
+    def __init__(self):
+        self._page_lock = threading.Lock()
+        self._page_keys = {} # {page version: render key}
+        self._page_order = []
+    
     # IRequestFilter methods
     def pre_process_request(self, req, handler):
+        # Share links and ticket fields between the plugin's hooks until the
+        # next request in this thread
+        request_cache.begin()
         return handler
         
     def post_process_request(self, req, template, data, content_type):
-        if req.path_info.startswith('/ticket/'):
-            # In case of an invalid ticket, the data is invalid
-            if not data:
-                return template, data, content_type
-            tkt = data['ticket']
-            links = TicketLinks(self.env, tkt)
-            
-            for i in links.blocked_by:
-                if Ticket(self.env, i)['status'] != 'closed':
-                    add_script(req, 'mastertickets/disable_resolve.js')
-                    break
-
-            data['mastertickets'] = {
-                'field_values': {
-                    'blocking': linkify_ids(self.env, req, links.blocking),
-                    'blockedby': linkify_ids(self.env, req, links.blocked_by),
-                },
-            }
-            
-            # Add link to depgraph if needed
-            if links:
-                add_ctxtnav(req, 'Depgraph', req.href.depgraph(tkt.id))
-            
-            for change in data.get('changes', {}):
-                if not change.has_key('fields'):
-                    continue
-                for field, field_data in change['fields'].iteritems():
-                    if field in self.fields:
-                        if field_data['new'].strip():
-                            new = set([int(n) for n in field_data['new'].split(',')])
-                        else:
-                            new = set()
-                        if field_data['old'].strip():
-                            old = set([int(n) for n in field_data['old'].split(',')])
-                        else:
-                            old = set()
-                        add = new - old
-                        sub = old - new
-                        elms = tag()
-                        if add:
-                            elms.append(
-                                tag.em(u', '.join([unicode(n) for n in sorted(add)]))
-                            )
-                            elms.append(u' added')
-                        if add and sub:
-                            elms.append(u'; ')
-                        if sub:
-                            elms.append(
-                                tag.em(u', '.join([unicode(n) for n in sorted(sub)]))
-                            )
-                            elms.append(u' removed')
-                        field_data['rendered'] = elms
-            
+        # In case of an invalid ticket, the data is invalid
+        if req.path_info.startswith('/ticket/') and data:
+            stats = MasterTicketsStats(self.env)
+            scope = stats.start('post_process_request', req)
+            try:
+                self._prepare_ticket_data(req, data)
+            finally:
+                stats.finish(scope)
+        request_cache.end()
         return template, data, content_type
         
+    def _prepare_ticket_data(self, req, data):
+        tkt = data['ticket']
+        links = TicketLinks(self.env, tkt)
+        
+        if open_blocker_counts(self.env, [tkt.id]):
+            add_script(req, 'mastertickets/disable_resolve.js')
+
+        data['mastertickets'] = {
+            'field_values': {
+                'blocking': self._link_field(req, tkt.id, 'blocking', links.blocking),
+                'blockedby': self._link_field(req, tkt.id, 'blockedby', links.blocked_by),
+            },
+        }
+        
+        # Add link to depgraph if needed
+        if links:
+            add_ctxtnav(req, 'Depgraph', req.href.depgraph(tkt.id))
+        
+        for change in data.get('changes', {}):
+            if not change.has_key('fields'):
+                continue
+            for field, field_data in change['fields'].iteritems():
+                if field in self.fields:
+                    # Ignores the * of hub fields
+                    new = set([int(n) for n in field_data['new'].split(',')
+                               if n.strip().isdigit()])
+                    old = set([int(n) for n in field_data['old'].split(',')
+                               if n.strip().isdigit()])
+                    add = new - old
+                    sub = old - new
+                    elms = tag()
+                    if add:
+                        elms.append(
+                            tag.em(u', '.join([unicode(n) for n in sorted(add)]))
+                        )
+                        elms.append(u' added')
+                    if add and sub:
+                        elms.append(u'; ')
+                    if sub:
+                        elms.append(
+                            tag.em(u', '.join([unicode(n) for n in sorted(sub)]))
+                        )
+                        elms.append(u' removed')
+                    field_data['rendered'] = elms
+        
+    def _link_field(self, req, tkt_id, field, ids):
+        """Render the first `link_field_limit` tickets of a link field,
+        followed by a link to load the others and their open and closed
+        counts."""
+        limit = self.link_field_limit
+        if limit <= 0 or len(ids) <= limit:
+            return linkify_ids(self.env, req, ids)
+        shown = sorted(ids)[:limit]
+        open_, closed = link_status_counts(self.env, tkt_id, field)
+        add_script(req, 'mastertickets/link_pages.js')
+        return tag.span(
+            linkify_ids(self.env, req, shown),
+            tag.span(' and ',
+                     tag.a('%d more' % (len(ids) - limit),
+                           href=req.href.depgraph(tkt_id, 'links', field=field,
+                                                  offset=limit),
+                           class_='mastertickets-more'),
+                     ' (%d open, %d closed)' % (open_, closed)))
+    
     # ITemplateStreamFilter methods
     def filter_stream(self, req, method, filename, stream, data):
         if 'mastertickets' in data:
@@ -107,11 +167,23 @@ class MasterTicketsModule(Component):
         pass
         
     def validate_ticket(self, req, ticket):
+        stats = MasterTicketsStats(self.env)
+        scope = stats.start('validate_ticket', req)
+        try:
+            for error in self._validate_ticket(req, ticket):
+                yield error
+        finally:
+            stats.finish(scope)
+    
+    def _validate_ticket(self, req, ticket):
         if req.args.get('action') == 'resolve':
+            if not open_blocker_counts(self.env, [ticket.id]):
+                return
             links = TicketLinks(self.env, ticket)
 
-            for i in links.blocked_by:
-                if Ticket(self.env, i)['status'] != 'closed':
+            blockers = load_ticket_attrs(self.env, links.blocked_by, ('status',))
+            for i in sorted(blockers):
+                if blockers[i]['status'] != 'closed':
                     user_warned = 'mastertickets-warning-#%s'%links.tkt.id
                     if req.session.has_key(user_warned) and time.time() - float(req.session[user_warned]) < 30:
                         #ignoring the warning, clear session and keep going.
@@ -138,49 +210,309 @@ class MasterTicketsModule(Component):
         return req.path_info.startswith('/depgraph')
 
     def process_request(self, req):
+        stats = MasterTicketsStats(self.env)
+        scope = stats.start('process_request', req)
+        try:
+            return self._process_request(req)
+        finally:
+            stats.finish(scope)
+    
+    def _process_request(self, req):
         path_info = req.path_info[10:]
         
         if not path_info:
             raise TracError('No ticket specified')
         
+        if path_info == 'ready':
+            return self._process_ready(req)
+        
+        if path_info == '_stats':
+            req.perm.require('TRAC_ADMIN')
+            data = MasterTicketsStats(self.env).snapshot()
+            data['renderer'] = GraphRenderer(self.env).metrics()
+            req.send(to_json(data), 'application/json')
+        
+        renderer = GraphRenderer(self.env)
+        if path_info.startswith('render/'):
+            # Graphs rendered and cached by the DepGraph macro
+            key = path_info[7:]
+            if key.endswith('.png'):
+                key = key[:-4]
+            if not renderer.has(key):
+                raise ResourceNotFound('Rendered graph %s not found' % key)
+            # The content of a key never changes
+            req.check_modified(from_utimestamp(0), key)
+            self._send_rendering(req, key, 'png', 'image/png')
+        
         tkt_id = path_info.split('/', 1)[0]
-        g = self._build_graph(req, tkt_id)
+        try:
+            tkt_id = int(tkt_id)
+        except ValueError:
+            raise ResourceNotFound('Ticket %s does not exist' % tkt_id)
+        if not load_ticket_attrs(self.env, [tkt_id], ()):
+            raise ResourceNotFound('Ticket %s does not exist' % tkt_id)
+        if path_info.endswith('/links'):
+            self._send_link_page(req, tkt_id)
+        if req.args.get('format') in ('json', 'ndjson'):
+            self._send_json(req, tkt_id)
+        format = req.args.get('format')
+        if format is not None and not GraphRenderer.FORMAT_RE.match(format):
+            raise HTTPBadRequest('Invalid format %r' % format)
+        
+        depth = req.args.get('depth')
+        if depth:
+            try:
+                depth = int(depth)
+            except ValueError:
+                raise TracError('Invalid depth %r' % depth)
+            links = links_within(self.env, tkt_id, depth,
+                                 closure=MasterTicketsSystem(self.env).use_closure)
+        else:
+            links = DependencyIndex(self.env).walk(tkt_id)
+        
+        # Links imported with trac-admin do not touch any changetime, so
+        # the ETag also covers the links themselves
+        changed = from_utimestamp(last_changed(self.env, links))
+        edges = [(n, sorted(links[n])) for n in sorted(links)]
+        version = sha1(repr((req.path_info, sorted(req.args.items()), edges,
+                             renderer.dot_path, renderer.use_gs,
+                             renderer.gs_path))).hexdigest()
+        req.send_header('Last-Modified', http_date(changed))
+        
         if '/' in path_info or 'format' in req.args:
+            # Answer conditional requests before building or rendering anything
+            req.check_modified(changed, version)
+            g = self._build_graph(req, tkt_id, links)
             
-            format = req.args.get('format')
             if format == 'text':
-                req.send(str(g), 'text/plain')
+                req.send(''.join(g.iter_dot()), 'text/plain')
             elif format == 'debug':
                 import pprint
                 req.send(pprint.pformat(TicketLinks(self.env, tkt_id)), 'text/plain')
-            elif format is not None:
-                req.send(g.render(self.dot_path, format), 'text/plain')
             
-            if self.use_gs:
-                ps = g.render(self.dot_path, 'ps2')
-                gs = subprocess.Popen([self.gs_path, '-q', '-dTextAlphaBits=4', '-dGraphicsAlphaBits=4', '-sDEVICE=png16m', '-sOutputFile=%stdout%', '-'], 
-                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                img, err = gs.communicate(ps)
-                if err:
-                    self.log.debug('MasterTickets: Error from gs: %s', err)
-            else:
-                img = g.render(self.dot_path)
-            req.send(img, 'image/png')
+            try:
+                if format is not None:
+                    self._send_rendering(req, renderer.cache(g, format), format,
+                                         'text/plain')
+                self._send_rendering(req, renderer.cache(g), 'png', 'image/png')
+            except RenderError, e:
+                req.send(unicode(e).encode('utf-8'), 'text/plain', 503)
         else:
+            # The page shows its image by render key, so a cached copy of
+            # the page is only current while that key is in the render cache
+            self._page_lock.acquire()
+            try:
+                graph_key = self._page_keys.get(version)
+            finally:
+                self._page_lock.release()
+            if graph_key is not None and renderer.has(graph_key):
+                req.check_modified(changed, [version, graph_key])
+            
+            g = self._build_graph(req, tkt_id, links)
             data = {}
             
             tkt = Ticket(self.env, tkt_id)
+            count('tickets')
             data['tkt'] = tkt
             data['graph'] = g
-            data['graph_render'] = partial(g.render, self.dot_path)
-            data['use_gs'] = self.use_gs
+            
+            data['graph_key'] = data['graph_map'] = data['graph_error'] = None
+            try:
+                data['graph_key'], data['graph_map'] = self.cache_graph(g)
+            except RenderError, e:
+                data['graph_error'] = e
+            else:
+                self._remember_page(version, data['graph_key'])
+                req.check_modified(changed, [version, data['graph_key']])
+            GraphPrerenderer(self.env).remember(req)
             
             add_ctxtnav(req, 'Back to Ticket #%s'%tkt.id, req.href.ticket(tkt_id))
             return 'depgraph.html', data, None
 
-    def _build_graph(self, req, tkt_id):
-        links = TicketLinks(self.env, tkt_id)
+    def cache_graph(self, g):
+        """Render `g` for a depgraph page and return the render cache key of
+        the image and the client-side image map, which is `None` when using
+        ghostscript.
+        
+        The image and the map are rendered with one dot run, and the image is
+        then served from the render cache by its key.
+        """
+        renderer = GraphRenderer(self.env)
+        if renderer.use_gs:
+            return renderer.cache(g, 'png'), None
+        keys = renderer.cache_many(g, ['png', 'cmapx'])
+        cmapx = renderer.get(keys['cmapx'], 'cmapx')
+        if cmapx is None:
+            raise RenderError('The rendered graph was removed from the cache')
+        return keys['png'], cmapx.decode('utf8')
+
+    def _process_ready(self, req):
+        """List open tickets that have no open blockers."""
+        req.perm.require('TICKET_VIEW')
+        
+        filters = {}
+        for field in ('milestone', 'owner'):
+            values = [x.lower() for x in req.args.get(field, '').split('|') if x]
+            if values:
+                filters[field] = values
+        try:
+            limit = min(max(int(req.args.get('max', 100)), 1), self.READY_PAGE_MAX)
+            offset = max(int(req.args.get('page', 1)) - 1, 0) * limit
+        except ValueError:
+            raise TracError('Invalid max or page argument')
+        
+        fields = ('summary', 'status', 'owner', 'priority', 'milestone')
+        tickets = []
+        for row in ready_tickets(self.env, fields, filters, limit, offset):
+            if 'TICKET_VIEW' in req.perm('ticket', row[0]):
+                tickets.append(dict(zip(('id',) + fields, row)))
+        
+        if req.args.get('format') == 'json':
+            req.send(to_json(tickets), 'application/json')
+        
+        data = {'tickets': tickets, 'page': offset // limit + 1, 'max': limit,
+                'filter_args': dict([(k, '|'.join(v)) for k, v in filters.items()])}
+        return 'depgraph_ready.html', data, None
+
+    def _send_json(self, req, tkt_id):
+        """Send the tickets around `tkt_id` and the links among them as
+        JSON, or as one JSON object per line with `format=ndjson`.
         
+        The walk can be limited with the `depth`, `direction` and
+        `max_nodes` arguments; `truncated` tells whether it was cut short.
+        Tickets are loaded and encoded in batches. In the JSON format the
+        edges follow the nodes, in NDJSON each edge follows the second of
+        its tickets.
+        """
+        args = {}
+        for name in ('depth', 'max_nodes'):
+            value = req.args.get(name)
+            if value:
+                try:
+                    args[name] = int(value)
+                except ValueError:
+                    raise TracError('Invalid %s %r' % (name, value))
+        direction = req.args.get('direction', 'both')
+        if direction not in ('both', 'blocking', 'blocked_by'):
+            raise TracError('Invalid direction %r' % direction)
+        req.perm('ticket', tkt_id).require('TICKET_VIEW')
+        
+        truncated = []
+        records = walk_links(self.env, [tkt_id], args.get('depth'),
+                             args.get('max_nodes'), direction=direction,
+                             truncated=truncated)
+        def batches():
+            batch = []
+            for record in records:
+                batch.append(record)
+                if len(batch) >= self.JSON_BATCH_SIZE:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        
+        ndjson = req.args['format'] == 'ndjson'
+        out = []
+        if not ndjson:
+            out.append('{"nodes": [')
+        included = set()
+        edges = []
+        for batch in batches():
+            attrs = load_ticket_attrs(self.env, [r.id for r in batch],
+                                      ('status', 'summary', 'milestone'))
+            for r in batch:
+                if r.id not in attrs or 'TICKET_VIEW' not in req.perm('ticket', r.id):
+                    continue
+                node = {'id': r.id, 'depth': r.depth, 'href': req.href.ticket(r.id)}
+                node.update(attrs[r.id])
+                # Each link is written once, with the second of its tickets
+                new_edges = [(r.id, n) for n in sorted(r.blocking) if n in included] + \
+                            [(n, r.id) for n in sorted(r.blocked_by) if n in included]
+                if ndjson:
+                    node['type'] = 'node'
+                    out.append(to_json(node) + '\n')
+                    for source, dest in new_edges:
+                        out.append(to_json({'type': 'edge', 'source': source,
+                                            'dest': dest}) + '\n')
+                else:
+                    out.append((included and ',' or '') + to_json(node))
+                    edges.extend(new_edges)
+                included.add(r.id)
+        truncated = bool(truncated)
+        
+        if ndjson:
+            out.append(to_json({'type': 'end', 'truncated': truncated}) + '\n')
+            req.send(''.join(out), 'application/x-ndjson')
+        out.append('], "edges": [')
+        out.append(','.join([to_json({'source': source, 'dest': dest})
+                             for source, dest in edges]))
+        out.append('], "truncated": %s}' % (truncated and 'true' or 'false'))
+        req.send(''.join(out), 'application/json')
+
+    def _send_link_page(self, req, tkt_id):
+        """Send one page of the `blocking` or `blockedby` links of `tkt_id`
+        as JSON, for the ticket page to load the links it does not show.
+        
+        `next` is the `offset` of the following page, or `null` after the
+        last one. Tickets the user may not view are left out.
+        """
+        field = req.args.get('field')
+        if field not in self.fields:
+            raise TracError('Invalid field %r' % field)
+        try:
+            tkt_id = int(tkt_id)
+            offset = max(int(req.args.get('offset', 0)), 0)
+            limit = int(req.args.get('limit', self.link_field_limit or 100))
+        except ValueError:
+            raise TracError('Invalid ticket, offset or limit')
+        limit = min(max(limit, 1), self.LINK_PAGE_MAX)
+        req.perm('ticket', tkt_id).require('TICKET_VIEW')
+        
+        total, ids = link_page(self.env, tkt_id, field, offset, limit)
+        attrs = load_ticket_attrs(self.env, ids, ('status', 'summary'))
+        tickets = []
+        for n in ids:
+            if n in attrs and 'TICKET_VIEW' in req.perm('ticket', n):
+                tickets.append({'id': n, 'href': req.href.ticket(n),
+                                'status': attrs[n]['status'],
+                                'summary': attrs[n]['summary']})
+        next_offset = offset + limit < total and offset + limit or None
+        req.send(to_json({'total': total, 'offset': offset, 'next': next_offset,
+                          'tickets': tickets}), 'application/json')
+    
+    def _send_rendering(self, req, key, format, mimetype):
+        """Stream a rendering from the render cache as the response."""
+        f = GraphRenderer(self.env).open(key, format)
+        if f is None:
+            raise ResourceNotFound('Rendered graph %s not found' % key)
+        try:
+            req.send_response(200)
+            req.send_header('Content-Type', mimetype)
+            req.send_header('Content-Length', os.fstat(f.fileno()).st_size)
+            req.end_headers()
+            if req.method != 'HEAD':
+                while True:
+                    chunk = f.read(self.SEND_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    req.write(chunk)
+        finally:
+            f.close()
+        raise RequestDone
+    
+    def _remember_page(self, version, graph_key):
+        self._page_lock.acquire()
+        try:
+            if version in self._page_keys:
+                self._page_order.remove(version)
+            elif len(self._page_keys) >= self.PAGE_MEMO_SIZE:
+                del self._page_keys[self._page_order.pop(0)]
+            self._page_order.append(version)
+            self._page_keys[version] = graph_key
+        finally:
+            self._page_lock.release()
+
+    def _build_graph(self, req, tkt_id, links=None):
         g = graphviz.Graph()
         
         node_default = g['node']
@@ -192,17 +524,20 @@ class MasterTicketsModule(Component):
         # Force this to the top of the graph
         g[tkt_id] 
         
-        links = sorted(links.walk(), key=lambda link: link.tkt.id)
-        for link in links:
-            tkt = link.tkt
-            node = g[tkt.id]
-            node['label'] = u'#%s'%tkt.id
-            node['fillcolor'] = tkt['status'] == 'closed' and 'green' or 'red'
-            node['URL'] = req.href.ticket(tkt.id)
-            node['alt'] = u'Ticket #%s'%tkt.id
-            node['tooltip'] = tkt['summary']
+        if links is None:
+            links = DependencyIndex(self.env).walk(tkt_id)
+        attrs = load_ticket_attrs(self.env, links, ('status', 'summary'))
+        for id in sorted(links):
+            node = g[id]
+            node['label'] = u'#%s'%id
+            node['URL'] = req.href.ticket(id)
+            node['alt'] = u'Ticket #%s'%id
+            tkt = attrs.get(id)
+            if tkt is not None:
+                node['fillcolor'] = tkt['status'] == 'closed' and 'green' or 'red'
+                node['tooltip'] = tkt['summary']
             
-            for n in link.blocking:
+            for n in links[id]:
                 node > g[n]
         
         return g